@@ -5,11 +5,9 @@ __author__ = 'Zhengtao Xiao'
 #usage: python apply_pynac.py config.txt
 ###############################################
 
-from openpyxl import load_workbook
 import sys,re,os
 from datetime import datetime
 from ConfigParser import ConfigParser
-import tempfile
 import csv
 
 #read config
@@ -22,15 +20,27 @@ conf["formulaCol"] = parser.getint("options","formulaCol")
 conf["formulaPattern"] = re.compile(parser.get("options","formulaPattern"))
 conf["intensityCols"] = eval(parser.get("options","intensityCols"))
 conf["outFile"] = parser.get("options","outFile")
+conf["tableStore"] = None
+if parser.has_option("options","tableStore"):
+	conf["tableStore"] = parser.get("options","tableStore")
+conf["resultStore"] = None
+if parser.has_option("options","resultStore"):
+	conf["resultStore"] = parser.get("options","resultStore")
 #add pynac path
 sys.path.append(conf["pynacDir"])
 from pynac.analysis.analysis import Analysis
+from pynac.analysis.nacpool import NACorrectorPool
+from pynac.analysis.nacache import NACache
+from pynac.analysis.nastore import NATableStore
+from pynac.analysis.resultstore import ResultStore
+from pynac.analysis.datasource import MemoryDataSource, WorkbookColumns
+from pynac.core import isotopelabels as IsotopeLabels
 
-#read the file		
-inWb = load_workbook(conf["inFile"])
-sheet = inWb.active
-max_ncol = sheet.max_column
-max_nrow = sheet.max_row
+#read only the needed columns of the file, as plain values
+formulaCol = conf["formulaCol"]
+columns = WorkbookColumns(conf["inFile"], [1,formulaCol] + conf["intensityCols"])
+max_ncol = columns.MaxColumn
+max_nrow = columns.MaxRow
 sys.stderr.write("There are: %i rows and %i columns\n" % (max_nrow,max_ncol))
 
 #read and extract the data
@@ -40,71 +50,78 @@ for i in conf["intensityCols"]:
 	outDataDict[i] = []
 	outDataDict[i].append(header)
 
-#with tempfile.TemporaryDirectory() as tmpdir: #for python3
-tmpdir = tempfile.mkdtemp()
-#tmpdirname = tmpdir.name # for python3
-tmpdirname = tmpdir
-
-sys.stderr.write("The temp files will be stored in %s\n" % tmpdirname)
 group_id = 1
-for row in sheet.rows:
-	if not str(row[0].value):
+for row_i in xrange(columns.Rows):
+	if not str(columns[1][row_i]):
 		sys.stderr.write("Error: please delete the blank rows")
 		sys.exit(1)
-	if row[0].row == 1:
+	if row_i == 0:
 		group_beg = 2
 		continue
-	if row[0].row == 2:
-		formula = row[conf["formulaCol"]-1].value
+	if row_i == 1:
+		formula = columns[formulaCol][row_i]
 		c13Count = "0"
-	if row[0].row >2:
-		m = re.match(conf["formulaPattern"],row[conf["formulaCol"]-1].value.strip())
+	if row_i > 1:
+		m = re.match(conf["formulaPattern"],columns[formulaCol][row_i].strip())
 		if m:
 			fromula = m.group("formula")
 			c13Count = m.group("C13_count")
 		else:
-			formula = row[conf["formulaCol"]-1].value
+			formula = columns[formulaCol][row_i]
 			c13Count = "0"
 			group_id += 1
 	groupKey = "group_" + str(group_id)
 	for col_i in conf["intensityCols"]:
-		outDataDict[col_i].append([groupKey,str(row[col_i-1].value),c13Count,formula])
-#write into files and generate config for pynac
+		outDataDict[col_i].append([groupKey,str(columns[col_i][row_i]),c13Count,formula])
+#run pynac on every intensity column in memory, the correctors and the NA
+#tables are shared by all the intensity columns
 finalData = {}
+store = None
+if conf["tableStore"]:
+	store = NATableStore(conf["tableStore"])
+pool = NACorrectorPool(NACache(list(IsotopeLabels.Supported),store))
+#groups corrected by an earlier run are read from the result store, its files
+#are unpickled so it must be a directory only trusted users can write to
+results = None
+if conf["resultStore"]:
+	results = ResultStore(conf["resultStore"])
+analyses = []
 for col_i in conf["intensityCols"]:
-	outFile = os.path.join(tmpdirname,str(col_i)+"_pynac_input.csv")
-	with open(outFile,"w") as fout:
-		for i in outDataDict[col_i]:
-			fout.write(",".join(i)+"\n")
-	#generate config file
-	configFile = os.path.join(tmpdirname,str(col_i)+"_pynac.conf")
-	resultFile = os.path.join(tmpdirname,str(col_i)+"_pynac_result.csv")
-	with open(configFile,"w") as fout:
-		fout.write('[PyNACOptions]' + "\n")
-		fout.write("DataFile:" + outFile + "\n")
-		fout.write('FormulaColumn: 3' + "\n")
-		fout.write("Groupcolumns: [0]" + "\n")
-		fout.write('IsotopeColumns: {"13C":2}' + "\n")
-		fout.write('IntensityColumn: 1' + "\n")
-		fout.write('SkipRows: [0]' + "\n")
-		fout.write('OutputFile: ' + resultFile + "\n")
-	#run pynac
 	analysis = Analysis()
-	analysis.ConfigureFromFile(configFile)
+	analysis.NACache = pool.Cache
+	analysis.CorrectorPool = pool
+	analysis.ResultStore = results
+	analysis.DataSource = MemoryDataSource(outDataDict[col_i])
+	analysis.Configuration = {
+		"FormulaColumn": 3,
+		"GroupColumns": [0],
+		"IsotopeColumns": {"13C":2},
+		"IntensityColumn": 1,
+		"SkipRows": [0]}
 	analysis.Initialize()
-	analysis.CorrectAll()
-	analysis.WriteOutput()
+	analyses.append(analysis)
+#every peak set is corrected for all the intensity columns at once
+analyses[0].CorrectAllWith(analyses[1:])
+if results:
+	sys.stderr.write("Result store: %i hits and %i misses\n" % (results.Hits,results.Misses))
+for col_i, analysis in zip(conf["intensityCols"],analyses):
+	columnnums = analysis.FillOutput()
 
-	#get the corrected data from pynac file
+	#get the corrected data from the pynac output rows
 	finalData[col_i] = []
-	correct_column = 7
-	with open(resultFile) as fin:
-		for line in fin:
-			tmp = line.strip().split(",")
-			try:
-				finalData[col_i].append(tmp[correct_column-1])
-			except IndexError:
-				finalData[col_i].append("0")
+	correct_column = columnnums["Corrected"]
+	for row in analysis.Output.IterRows():
+		if correct_column >= len(row):
+			finalData[col_i].append("0")
+			continue
+		value = row[correct_column]
+		if isinstance(value,float):
+			value = repr(value)
+		value = str(value)
+		#trailing blanks of the last cell were stripped with the line
+		if correct_column == len(row)-1:
+			value = value.strip()
+		finalData[col_i].append(value)
 
 	
 #combine the pynac result into one file
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+###############################################
+#usage: python benchmark.py [options], see python benchmark.py -h
+###############################################
+# Standard Packages
+import argparse, json, os, platform, shutil, subprocess, sys, tempfile, time
+import numpy
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+# Custom Packages
+from pynac.core              import isotopelabels as IsotopeLabels
+from pynac.analysis.analysis import Analysis
+from pynac.analysis.nacache  import NACache
+from pynac.analysis.nacpool  import NACorrectorPool
+from synthetic               import SyntheticDataset
+
+STAGES = ["tables", "ingest", "correction", "output"]
+
+def Version():
+  # Version of the source tree, "unknown" outside of a git checkout
+  directory = os.path.dirname(os.path.abspath(__file__))
+  try:
+    command = ["git", "describe", "--always", "--dirty"]
+    return subprocess.check_output(command, cwd=directory,
+                                   stderr=open(os.devnull, "w")).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return "unknown"
+
+def RunOnce(dataset, filepath, directory, options):
+  """
+  RunOnce Function
+  ================
+    Description
+    -----------
+    Corrects every sample of the data set written to "filepath" the way
+    apply_pynac does (one analysis per sample sharing the NA tables and the
+    correctors) and writes the outputs to "directory".
+
+    Returns
+    -------
+    A tuple (times, analyses) where times holds the wall time of each of
+    STAGES in seconds, starting from an empty NA table cache.
+  """
+  times = {}
+  start = time.time()
+  cache = NACache(list(IsotopeLabels.Supported))
+  for isotope, maximum in sorted(dataset.Tables):
+    cache.BuildTable(isotope, maximum)
+  pool  = NACorrectorPool(cache)
+  times["tables"] = time.time() - start
+  start = time.time()
+  analyses = []
+  for sample in xrange(dataset.Samples):
+    analysis = Analysis()
+    analysis.NACache       = cache
+    analysis.CorrectorPool = pool
+    analysis.Configuration = dataset.Configuration(sample)
+    analysis.Configuration["DataFile"] = filepath
+    analysis.Configuration.update(options)
+    analysis.Initialize()
+    analyses.append(analysis)
+  times["ingest"] = time.time() - start
+  start = time.time()
+  if(len(analyses) > 1 and analyses[0].Configuration["Workers"] == 1):
+    analyses[0].CorrectAllWith(analyses[1:])
+  else:
+    for analysis in analyses: analysis.CorrectAll()
+  times["correction"] = time.time() - start
+  start = time.time()
+  for sample in xrange(len(analyses)):
+    analyses[sample].WriteOutput(os.path.join(directory, "output" + str(sample) + ".csv"))
+  times["output"] = time.time() - start
+  return (times, analyses)
+
+def CheckResults(dataset, analyses):
+  """
+  CheckResults Function
+  =====================
+    Description
+    -----------
+    Compares the corrected intensity of every observed isotopologue with
+    its known intensity. Errors are relative to the total known intensity
+    of the group in the sample.
+
+    Returns
+    -------
+    A dictionary with the number of values compared, the number of values
+    missing from the output and the largest relative error.
+  """
+  group, samples, labels, formula, truth = dataset.Columns()
+  checked = 0
+  missing = 0
+  error   = 0.0
+  for sample in xrange(len(analyses)):
+    totals = {}
+    for row in dataset.Rows[1:]:
+      totals[row[group]] = totals.get(row[group], 0.0) + float(row[truth[sample]])
+    output = analyses[sample].Output
+    column = output.Columns["Corrected"]
+    for row in output.IterRows():
+      if(row[group] not in totals or len(row) <= column): continue
+      if(row[column] == " "):
+        missing += 1
+        continue
+      known = float(row[truth[sample]])
+      error = max(error, abs(float(row[column]) - known)/totals[row[group]])
+      checked += 1
+  return {"checked" : checked, "missing" : missing, "max_relative_error" : error}
+
+def Summary(times, rows, groups):
+  # Fastest time of every stage over the repeats and the throughput of the
+  # fastest whole run
+  summary = {}
+  for stage in STAGES:
+    summary[stage] = min([run[stage] for run in times])
+  total = min([sum(run.values()) for run in times])
+  summary["total"] = total
+  summary["rows_per_second"]   = rows/total if(total > 0) else None
+  summary["groups_per_second"] = groups/total if(total > 0) else None
+  return summary
+
+def ParseArguments():
+  parser = argparse.ArgumentParser(description="Times the NA correction of a "
+    "synthetic data set stage by stage and checks the corrected values against "
+    "the known ones")
+  parser.add_argument("--groups",    type=int,   default=200)
+  parser.add_argument("--samples",   type=int,   default=4)
+  parser.add_argument("--labels",    default="13C",
+                      help="comma separated label order, e.g. 13C,15N,2H")
+  parser.add_argument("--sparsity",  type=float, default=0.0,
+                      help="fraction of isotopologues without known intensity")
+  parser.add_argument("--seed",      type=int,   default=0)
+  parser.add_argument("--repeat",    type=int,   default=3)
+  parser.add_argument("--engine",    default="numpy")
+  parser.add_argument("--solver",    default="fixedpoint")
+  parser.add_argument("--workers",   type=int,   default=1)
+  parser.add_argument("--tolerance", type=float, default=1e-9,
+                      help="largest relative error accepted")
+  parser.add_argument("--results",   default=None,
+                      help="file the results are appended to as one JSON line")
+  parser.add_argument("--keep",      default=None,
+                      help="directory to keep the data set and outputs in")
+  return parser.parse_args()
+
+def Main():
+  args    = ParseArguments()
+  labels  = tuple(args.labels.split(","))
+  for label in labels:
+    if(not IsotopeLabels.IsSupported(label)):
+      sys.stderr.write("Unsupported label '{0}'\n".format(label))
+      return 2
+  dataset = SyntheticDataset(args.groups, args.samples, labels, args.sparsity,
+                             args.seed)
+  options = {"Engine" : args.engine, "Solver" : args.solver,
+             "Workers": args.workers}
+  directory = args.keep or tempfile.mkdtemp(prefix="pynac_benchmark_")
+  if(not os.path.isdir(directory)): os.makedirs(directory)
+  try:
+    filepath = os.path.join(directory, "synthetic.csv")
+    start = time.time()
+    dataset.Write(filepath)
+    generation = time.time() - start
+    times = []
+    for repeat in xrange(args.repeat):
+      run, analyses = RunOnce(dataset, filepath, directory, options)
+      times.append(run)
+    accuracy = CheckResults(dataset, analyses)
+  finally:
+    if(not args.keep): shutil.rmtree(directory)
+  rows   = (len(dataset.Rows) - 1)*args.samples
+  record = {"version"    : Version(),
+            "time"       : time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python"     : platform.python_version(),
+            "numpy"      : numpy.__version__,
+            "machine"    : platform.machine(),
+            "dataset"    : dataset.Parameters,
+            "options"    : options,
+            "rows"       : rows,
+            "generation" : generation,
+            "times"      : times,
+            "summary"    : Summary(times, rows, args.groups*args.samples),
+            "accuracy"   : accuracy,
+            "passed"     : (accuracy["missing"] == 0 and
+                            accuracy["max_relative_error"] <= args.tolerance)}
+  print json.dumps(record, indent=1, sort_keys=True)
+  if(args.results):
+    with open(args.results, "a") as results:
+      results.write(json.dumps(record, sort_keys=True) + "\n")
+  if(not record["passed"]):
+    sys.stderr.write("Corrected values differ from the known ones\n")
+    return 1
+  return 0
+
+if(__name__ == "__main__"):
+  sys.exit(Main())
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# Standard Packages
+import csv, numpy
+# Custom Packages
+from pynac.core              import isotopelabels as IsotopeLabels
+from pynac.analysis.nacpool  import NACorrectorPool
+
+# Largest number of atoms of the element of every label in random formulas
+DEFAULT_MAXIMUMS = {"13C": 20, "15N": 4, "2H": 6}
+
+def RandomFormula(state, labels, maximums=DEFAULT_MAXIMUMS):
+  """
+  RandomFormula Function
+  ======================
+    Description
+    -----------
+    Random formula with 1 to maximums[label] atoms of the element of every
+    label in "labels" and a few oxygens, drawn from the numpy RandomState
+    "state".
+
+    Returns
+    -------
+    A tuple (formula, counts) where counts maps every label to its number
+    of atoms in the formula.
+  """
+  counts = {}
+  parts  = []
+  for isotope in labels:
+    counts[isotope] = state.randint(1, maximums[isotope] + 1)
+    parts.append(IsotopeLabels.ElementSymbol[isotope] + str(counts[isotope]))
+  parts.append("O" + str(state.randint(1, 7)))
+  return ("".join(parts), counts)
+
+def RandomEnrichment(state, shape, samples, sparsity):
+  """
+  RandomEnrichment Function
+  =========================
+    Description
+    -----------
+    Known (natural abundance free) intensities of a peak set of shape
+    "shape" in "samples" samples, as an array of shape (samples,) + shape.
+    A fraction "sparsity" of the isotopologues, the same ones in every
+    sample, has no intensity. The unlabeled isotopologue always has some.
+  """
+  zero = state.uniform(size=shape) < sparsity
+  zero.flat[0] = False
+  scale  = 10**state.uniform(4, 7, size=samples)
+  values = state.uniform(0.0, 1.0, size=(samples,) + tuple(shape))
+  values = values*scale.reshape((samples,) + (1,)*len(shape))
+  values[:, zero] = 0.0
+  return values
+
+class SyntheticDataset(object):
+  """
+  SyntheticDataset Object
+  =======================
+    Description
+    -----------
+    Synthetic isotopologue data set with known answers. Every group gets a
+    random formula over the labels in "labels", random known intensities
+    (RandomEnrichment) in every sample, and its observed intensities are
+    the known ones pushed through NACorrector.AddNA. Write saves it as a
+    CSV file with one row per isotopologue:
+
+      Group, S1 .. Sn, label counts (one column per label), Formula,
+      Truth1 .. Truthn
+
+    where S are the observed and Truth the known intensities of every
+    sample, so correcting column S of a row should give column Truth.
+    Configuration returns the analysis configuration of a sample.
+
+    Example
+    -------
+    >>> dataset = SyntheticDataset(groups=500, samples=4, labels=("13C","15N"))
+    >>> dataset.Write("synthetic.csv")
+  """
+  def __init__(self, groups=100, samples=1, labels=("13C",), sparsity=0.0,
+               seed=0, maximums=DEFAULT_MAXIMUMS):
+    self.Groups    = groups
+    self.Samples   = samples
+    self.Labels    = tuple(labels)
+    self.Sparsity  = sparsity
+    self.Seed      = seed
+    self.Maximums  = dict(maximums)
+    self.Rows      = None
+    # (isotope, maximum) of every table the data set needs
+    self.Tables    = set()
+
+  @property
+  def Parameters(self):
+    return {"groups"   : self.Groups,
+            "samples"  : self.Samples,
+            "labels"   : list(self.Labels),
+            "sparsity" : self.Sparsity,
+            "seed"     : self.Seed,
+            "maximums" : self.Maximums}
+
+  def Columns(self):
+    # Column numbers of the group, the samples, the labels, the formula and
+    # the known intensities
+    samples = range(1, self.Samples + 1)
+    labels  = dict([(self.Labels[i], self.Samples + 1 + i)
+                    for i in xrange(len(self.Labels))])
+    formula = self.Samples + 1 + len(self.Labels)
+    truth   = range(formula + 1, formula + 1 + self.Samples)
+    return (0, samples, labels, formula, truth)
+
+  def Configuration(self, sample=0):
+    group, samples, labels, formula, truth = self.Columns()
+    return {"FormulaColumn"   : formula,
+            "GroupColumns"    : [group],
+            "IsotopeColumns"  : dict(labels),
+            "IntensityColumn" : samples[sample],
+            "SkipRows"        : [0]}
+
+  def Build(self):
+    state = numpy.random.RandomState(self.Seed)
+    pool  = NACorrectorPool()
+    rows  = [["Group"] + ["S" + str(i) for i in xrange(1, self.Samples + 1)] +
+             list(self.Labels) + ["Formula"] +
+             ["Truth" + str(i) for i in xrange(1, self.Samples + 1)]]
+    self.Tables = set()
+    for group in xrange(self.Groups):
+      formula, counts = RandomFormula(state, self.Labels, self.Maximums)
+      shape = tuple([counts[isotope] + 1 for isotope in self.Labels])
+      for isotope in self.Labels: self.Tables.add((isotope, counts[isotope]))
+      truth     = RandomEnrichment(state, shape, self.Samples, self.Sparsity)
+      corrector = pool.Get(self.Labels, shape)
+      observed  = [numpy.asarray(corrector.AddNA(truth[sample]))
+                   for sample in xrange(self.Samples)]
+      key = "g" + str(group)
+      for index in numpy.ndindex(*shape):
+        rows.append([key] +
+                    [repr(float(observed[sample][index])) for sample in xrange(self.Samples)] +
+                    [str(count) for count in index] + [formula] +
+                    [repr(float(truth[sample][index])) for sample in xrange(self.Samples)])
+    self.Rows = rows
+    return rows
+
+  def Write(self, filepath):
+    if(self.Rows is None): self.Build()
+    ofile  = open(filepath, "wb")
+    writer = csv.writer(ofile)
+    writer.writerows(self.Rows)
+    ofile.close()
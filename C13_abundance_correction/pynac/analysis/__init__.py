@@ -1 +1 @@
-__all__ = ["mpanalysis","datasource","nacache","peakstructures"]
\ No newline at end of file
+__all__ = ["mpanalysis","datasource","diagnostics","instrument","nacache","nacpool","nastore","peakstructures","resultstore","streaming"]
\ No newline at end of file
@@ -1,13 +1,20 @@
 # Standard Packages
 import ConfigParser as cp
-import re, os, sys, numpy
+import re, os, sys, json, numpy, multiprocessing
 # Custom Packages 
 from pynac.core           import isotopelabels as IsotopeLabels  
 from pynac.core.nalookup  import *
 from pynac.core.nacmath   import *
+from pynac.core.naresults import PeakResults
 from peakstructures       import *
 from nacache              import * 
+from nastore              import *
+from resultstore          import ResultStore
+from nacpool              import *
+from mpanalysis           import *
 from datasource           import *
+from instrument           import StageTimer, PeakMemory
+from diagnostics          import SolverDiagnostics
 ############################################################
 # Default output structures
 ALL_OUTPUT = {
@@ -20,10 +27,14 @@ ALL_OUTPUT = {
     "Comments"              : "Comments",
     # Algorithm Performance Information
     "Iterations"            : "Iterations",
+    "StopReason"            : "Stop Reason",
+    "Residual"              : "Residual",
     "SampleGroupKey"        : "Sample Group Key"}
 PERFORMANCE_OUTPUT = {
     # Algorithm Performance Information
     "Iterations"            : "Iterations",
+    "StopReason"            : "Stop Reason",
+    "Residual"              : "Residual",
     "SampleGroupKey"        : "Sample Group Key"}
 RESULTS_OUTPUT = {
     # Analysis Results
@@ -41,7 +52,9 @@ class DataExtractor(object):
     key = []
     grouping = tuple(grouping) #self.Configuration["GroupColumns"]
     for column in grouping:
-      key.append(str(data[column]))
+      # Floats of columnar data sources as the text they were read from
+      if(isinstance(data[column], float)): key.append(repr(data[column]))
+      else                               : key.append(str(data[column]))
     return tuple(key)
     
   def ConstructPeak(self, data, intcol, isocols):
@@ -70,6 +83,8 @@ class DataExtractor(object):
       raise RuntimeError("Data file '{0}' does not exist".format(filepath))
     if(extension.lower() == ".csv"):
       return CSVDataSource(filepath)
+    elif(extension.lower() == COLUMNAR_EXTENSION):
+      return ColumnarDataSource(filepath)
     else:
       raise RuntimeError("Unsupported file type '{0}'".format(extension))
 
@@ -91,8 +106,17 @@ class Analysis(DataExtractor):
     self.PeakSets      = {}      
     self.PeakRowMap    = {}      
     self.Results       = None      
+    # Shared nacache.NACache, one of its own if not set
     self.NACache       = None
+    # Shared nacpool.NACorrectorPool, one of its own if not set
+    self.CorrectorPool = None
+    # resultstore.ResultStore of the "ResultStore" option, None without it
+    self.ResultStore   = None
     self.SetErrors     = []
+    # Output built by FillOutput
+    self.Output        = None
+    # Time spent in every stage, see Report
+    self.Timer         = StageTimer()
 
   def ConfigureFromFile(self, file):
     s = "PyNACOptions"
@@ -122,84 +146,198 @@ class Analysis(DataExtractor):
     except : pass
     try    : c["Output"       ] = eval(p.get(s,"Output"))
     except : pass
+    try    : c["Engine"       ] = str(p.get(s,"Engine"))
+    except : pass
+    try    : c["Solver"       ] = str(p.get(s,"Solver"))
+    except : pass
+    try    : c["AbsoluteTolerance"] = float(p.get(s,"AbsoluteTolerance"))
+    except : pass
+    try    : c["RelativeTolerance"] = float(p.get(s,"RelativeTolerance"))
+    except : pass
+    try    : c["MaxIterations"] = int(p.get(s,"MaxIterations"))
+    except : pass
+    try    : c["Patience"     ] = int(p.get(s,"Patience"))
+    except : pass
+    try    : c["Acceleration" ] = str(p.get(s,"Acceleration"))
+    except : pass
+    try    : c["TableStore"   ] = str(p.get(s,"TableStore"))
+    except : pass
+    try    : c["CacheBudget"  ] = int(p.get(s,"CacheBudget"))
+    except : pass
+    try    : c["ResultStore"  ] = str(p.get(s,"ResultStore"))
+    except : pass
+    try    : c["Workers"      ] = int(p.get(s,"Workers"))
+    except : pass
+    try    : c["SortedInput"  ] = p.getboolean(s,"SortedInput")
+    except : pass
+    try    : c["Sparse"       ] = p.getboolean(s,"Sparse")
+    except : pass
+    try    : c["SpillRows"    ] = int(p.get(s,"SpillRows"))
+    except : pass
+    try    : c["ReportFile"   ] = str(p.get(s,"ReportFile"))
+    except : pass
+    try    : c["DiagnosticsFile"] = str(p.get(s,"DiagnosticsFile"))
+    except : pass
+    if(str(c.get("Acceleration")).lower() in ("none", "")):
+      c.pop("Acceleration", None)
     ###########################################################
     self.Configuration = self.__fillconfdefaults(c)
     self.Configuration["Filled"] = True
 
   def Initialize(self):
-    if(not self.Configuration):
-      raise RuntimeError("Analysis not configured")
-    else:
-      if(not self.Configuration.has_key("Filled")):
-        self.Configuration = self.__fillconfdefaults(self.Configuration)
-        
+    start = self.Timer.Start()
+    self.CheckConfiguration()
     if(not self.DataSource):
       try:
         self.DataSource = self.DataSourceMagic(self.Configuration["DataFile"])
       except KeyError: 
         raise RuntimeError("No data source has been specified")
         
-    isotopes  = self.Configuration["IsotopeColumns"].keys()
     threshold = self.Configuration["Threshold"]
     self.Results = {}
 
     # Read in all the data, build all the NA lookups we will need
-    self.NACache = NACache(isotopes)
+    self.InitializeCaches()
     self.DataSource.ReadAll(subscriber=self)
     # Initialization done, now apply threshold to peak sets
     self.Initialized = True
     threshold = self.__resolvethreshold(threshold)
     for set in self.PeakSets.itervalues():
       set.Threshold = threshold
+    self.Timer.Stop("Initialize", start, rows=self.DataSource.MaxRow+1,
+                    groups=len(self.PeakSets))
+
+  def CheckConfiguration(self):
+    if(not self.Configuration):
+      raise RuntimeError("Analysis not configured")
+    else:
+      if(not self.Configuration.has_key("Filled")):
+        self.Configuration = self.__fillconfdefaults(self.Configuration)
+
+  def InitializeCaches(self):
+    # NA table cache and corrector pool, unless they are shared ones
+    isotopes = self.Configuration["IsotopeColumns"].keys()
+    store    = self.Configuration.get("TableStore")
+    if(store): store = NATableStore(store)
+    if(not self.NACache):
+      self.NACache = NACache(isotopes, store, self.Configuration.get("CacheBudget"))
+    if(not self.CorrectorPool): self.CorrectorPool = NACorrectorPool(self.NACache)
+    if(not self.ResultStore and self.Configuration.get("ResultStore")):
+      self.ResultStore = ResultStore(self.Configuration["ResultStore"])
 
   def CorrectAll(self):
     if(not self.Initialized):
       raise RuntimeError("Analysis has not been initialized")
-    # Enqueue all sets to run the correction analysis
-    for key,set in self.PeakSets.iteritems():
-      if(len(set.Shape) == 0):
-        emsg = "Bad set with key {0}".format(str(key))
-        sys.stderr.write(emsg+"\n")
-        self.SetErrors.append(emsg)
-        continue
-      if(len(set.RawData) == 0):
-        emsg = "Zero length set with key {0}".format(str(key))
-        sys.stderr.write(emsg+"\n")
-        self.SetErrors.append(emsg)
-        continue
-      self.Results[key] = self.CorrectNA(set)
+    start   = self.Timer.Start()
+    queue   = self.__queue()
+    workers = self.Configuration["Workers"]
+    if(workers <= 0): workers = multiprocessing.cpu_count()
+    if(workers == 1 or len(queue) < 2):
+      for key in queue:
+        self.Results[key] = self.CheckResults(key, self.CorrectNA(self.PeakSets[key]))
+      self.Timer.Stop("CorrectAll", start, groups=len(queue))
+      return
+    # Only the data of the sets is sent to the worker processes, the
+    # results are merged back in queue order. Sparse sets send their peaks,
+    # sets found in the result store are not sent at all.
+    store   = self.ResultStore
+    results = {}
+    keys    = {}
+    tasks   = []
+    for key in queue:
+      set = self.PeakSets[key]
+      if(store):
+        keys[key] = store.Key(set, self.__storeoptions())
+        stored    = store.Load(keys[key])
+        if(stored is not None):
+          results[key] = self.__restore(set, stored)
+          continue
+      data = set.RawData if(self.Configuration["Sparse"]) else self.SetData(set)
+      tasks.append((key, set.LabelOrder, set.Shape, data, set.Threshold))
+    for result in CorrectSets(tasks, workers, self.__correctoroptions(),
+                              self.Configuration.get("TableStore"), store is not None):
+      results[result[0]] = result[1]
+      if(store): store.Save(keys[result[0]], result[2])
+    for key in queue:
+      self.Results[key] = self.CheckResults(key, results[key])
+    self.Timer.Stop("CorrectAll", start, groups=len(queue))
+
+  def CorrectAllWith(self, analyses):
+    # Corrects this analysis and every analysis in "analyses" at once. The
+    # analyses must have read the same rows with different intensity columns
+    # so they have the same peak sets, every peak set is then corrected for
+    # all of them with a single NACorrector.RunBatch
+    group = [self] + list(analyses)
+    for analysis in group:
+      if(not analysis.Initialized):
+        raise RuntimeError("Analysis has not been initialized")
+    # Batches need the dense data of the numpy engine, stored results are
+    # looked up set by set
+    if(self.Configuration["Engine"] != "numpy" or self.Configuration["Sparse"] or
+       any([analysis.ResultStore for analysis in group])):
+      for analysis in group: analysis.CorrectAll()
+      return
+    start  = self.Timer.Start()
+    queues = [analysis.__queue() for analysis in group]
+    for key in queues[0]:
+      set = self.PeakSets[key]
+      corrector = self.CorrectorPool.Get(set.LabelOrder, set.Shape,
+                                         **self.__correctoroptions())
+      data = [analysis.SetData(analysis.PeakSets[key]) for analysis in group]
+      corrector.RunBatch(numpy.array(data, dtype=float))
+      for sample in xrange(len(group)):
+        threshold = group[sample].PeakSets[key].Threshold
+        group[sample].Results[key] = group[sample].CheckResults(key,
+          corrector.FilterFormatResults(threshold, sample))
+      corrector.Release()
+    # Every set of every analysis counts as a group
+    self.Timer.Stop("CorrectAll", start, groups=len(queues[0])*len(group))
 
   def CorrectNA(self, set):
     if(not self.Initialized):
       raise RuntimeError("Analysis has not been initialized")
-    # Build the appropriate NATables from the cache
-    lookup = {}
-    ptables = []
-    stables = []
-    for axis in xrange(len(set.LabelOrder)):
-      isotope = set.LabelOrder[axis]
-      # Don't add tables if this set does not incorporate the isotope
-      if set.IsotopeMaximum(isotope) > 0:
-        tables = self.NACache[isotope, set.IsotopeMaximum(isotope)]
-        ptables.append(tables[0]) # Product Lookups
-        stables.append(tables[1]) # Sum Product Lookups
-    dimensions = len(set.Shape)
-    if(dimensions == 1): 
+    start = self.Timer.Start()
+    # Sets already in the result store are not corrected again
+    store = self.ResultStore
+    if(store):
+      key    = store.Key(set, self.__storeoptions())
+      stored = store.Load(key)
+      if(stored is not None):
+        results = self.__restore(set, stored)
+        self.Timer.Stop("CorrectNA", start, groups=1)
+        return results
+    # Reuse the corrector of every set with the same labels and shape
+    analysis = self.CorrectorPool.Get(set.LabelOrder, set.Shape,
+                                      **self.__correctoroptions())
+    if(self.Configuration["Sparse"]): analysis.RunSparse(set.RawData)
+    else                            : analysis.Run(self.SetData(set))
+    if(store): store.Save(key, analysis.RawResults)
+    results = analysis.FilterFormatResults(set.Threshold)
+    analysis.Release()
+    self.Timer.Stop("CorrectNA", start, groups=1)
+    return results
+
+  def CheckResults(self, key, results):
+    # Records the sets corrected with another solver than the configured
+    # one in SetErrors, returns "results"
+    if(results.has_key("#Fallback")):
+      emsg = "{0} in set with key {1}".format(results["#Fallback"], str(key))
+      sys.stderr.write(emsg+"\n")
+      self.SetErrors.append(emsg)
+    return results
+
+  def SetData(self, set):
+    # Intensities of a peak set as the list (single label) or numpy ndarray
+    # (multiple labels) NACorrector.Run expects
+    coordinates = set.Coordinates
+    if(len(set.Shape) == 1): 
       data = [0]*(set.Shape[0])
-      slookup = stables[0]
-      plookup = ptables[0]
+      for count, intensity in zip(coordinates[:,0], set.Intensities.tolist()):
+        data[count] = intensity
     else:
       data = numpy.zeros(shape=set.Shape, dtype=float)
-      slookup = NASumProduct(stables)
-      plookup = NAProduct(ptables)
-    for coordinates in set.RawData:
-      if(dimensions == 1): 
-        data[coordinates[0]] = set.RawData[coordinates]
-      else: 
-        data[coordinates] = set.RawData[coordinates]
-    analysis = NACorrector(set.LabelOrder, set.Shape, slookup, plookup)
-    analysis.Run(data)
-    return analysis.FilterFormatResults(set.Threshold)
+      data[tuple(coordinates.T)] = set.Intensities
+    return data
 
   def WriteOutput(self, filepath=None):
     if(not self.Configuration):
@@ -210,56 +348,137 @@ class Analysis(DataExtractor):
       raise RuntimeError("No output file specified")
     elif(filepath == None):
       filepath = self.Configuration["OutputFile"]
-    # Add headers and get their column numbers
-    columnnums = self.__fillheaders()
-    #########################################################################
-    # Iterate through set results and write
+    start = self.Timer.Start()
+    self.FillOutput()
+    # Write everything to the file specified by filepath
+    self.Output.Write(filepath)
+    self.Timer.Stop("WriteOutput", start, rows=self.Output.Count)
+    if(self.Configuration.has_key("ReportFile")):
+      self.WriteReport(self.Configuration["ReportFile"])
+    if(self.Configuration.has_key("DiagnosticsFile")):
+      self.WriteDiagnostics(self.Configuration["DiagnosticsFile"])
+
+  def Diagnostics(self):
+    # SolverDiagnostics of every corrected set, with the solver traces when
+    # the "DiagnosticsFile" option is set
+    diagnostics = SolverDiagnostics()
+    for key, results in self.Results.iteritems():
+      diagnostics.Add(key, self.PeakSets[key], results)
+    return diagnostics
+
+  def WriteDiagnostics(self, filepath):
+    # Writes Diagnostics to filepath as CSV
+    self.Diagnostics().Write(filepath)
+
+  def Report(self):
+    """
+    Report Function
+    ===============
+      Description
+      -----------
+      Performance report of this analysis: the wall and CPU time, calls,
+      rows and groups handled, throughput and peak memory of every timed
+      stage (Initialize, CorrectAll, CorrectNA, WriteOutput and the
+      BuildTable calls of the NA table cache), the statistics of the NA
+      table cache, of the corrector pool and of the result store (hits,
+      misses and hit rate, None without a store) and the peak memory of the
+      process. The cache and the pool may be shared with other analyses.
+    """
+    stages = self.Timer.Report()
+    cache  = None
+    pool   = None
+    if(self.NACache):
+      stages.update(self.NACache.Timer.Report())
+      cache = self.NACache.Statistics
+    results = self.ResultStore.Statistics if(self.ResultStore) else None
+    if(self.CorrectorPool):
+      pool = {"Hits"       : self.CorrectorPool.Hits,
+              "Misses"     : self.CorrectorPool.Misses,
+              "Evictions"  : self.CorrectorPool.Evictions,
+              "Correctors" : len(self.CorrectorPool.Correctors),
+              "LookupBytes": self.CorrectorPool.LookupBytes}
+    return {"stages"      : stages,
+            "cache"       : cache,
+            "correctors"  : pool,
+            "results"     : results,
+            "rows"        : self.DataSource.MaxRow+1 if(self.DataSource) else 0,
+            "groups"      : len(self.PeakSets),
+            "peak_memory" : PeakMemory()}
+
+  def WriteReport(self, filepath):
+    # Writes Report to filepath as JSON
+    ofile = open(filepath, "w")
+    json.dump(self.Report(), ofile, indent=1)
+    ofile.close()
+
+  def FillOutput(self):
+    # Builds the output (a datasource.ColumnarOutput in Output) without
+    # writing it, returns the column number of every output option
+    if(not self.Configuration):
+      raise RuntimeError("Analysis not configured")
+    if(not self.Results):
+      raise RuntimeError("No results to output")
+    options = self.Configuration["Output"]
+    # Peak results of every set in the order of their entries, with their row
+    # numbers (-1 for the unobserved peaks that get a new row, added in the
+    # order of the entries)
+    order   = {}
+    extra   = 0
     for setkey in self.Results:
-      setresults  = self.Results[setkey]
       peakresults = self.Results[setkey]["#PeakResults"]
       set         = self.PeakSets[setkey]
-      #########################################################################
-      # Iterate through peak results and write
-      for coordinates in peakresults:
-        observed = set.RawSet.has_key(coordinates)
-        if(not observed):
-          comment = "Note: A value for this peak was predicted but not found in the original data"
-          rownum  = self.DataSource.MaxRow+1
-          self.__fillunobserved(rownum, coordinates, setkey)
-        else:
-          peak    = set.RawSet[coordinates]
-          comment = peak.Comment
-          rownum  = self.PeakRowMap[peak]
-        #########################################################################
-        # Special output options
-        if(columnnums.has_key("SampleGroupKey")):
-          self.DataSource.AddCell(rownum, columnnums["SampleGroupKey"], setkey)
-        if(columnnums.has_key("Comments")):
-          self.DataSource.AddCell(rownum, columnnums["Comments"], comment)
-        #########################################################################
-        # Regular peak level output options
-        for option in peakresults[coordinates]:
-          if(columnnums.has_key(option)):
-            self.DataSource.AddCell(rownum, columnnums[option], peakresults[coordinates][option])
-        #########################################################################
-        # Regular set level output options
-        for option in setresults:
-          # All keys begining with '#' in front are skipped
-          if(option[0] == "#"): continue
-          if(columnnums.has_key(option)):
-            self.DataSource.AddCell(rownum, columnnums[option], setresults[option])
-      #########################################################################
-      # Iterate through bad peaks and write their information
-      for peak in self.BadPeaks:
-        rownum = self.PeakRowMap[peak]
-        comment = peak.Comment
-        if(columnnums.has_key("SampleGroupKey")):
-          self.DataSource.AddCell(rownum, columnnums["SampleGroupKey"], setkey)
-        if(columnnums.has_key("Comments")):
-          self.DataSource.AddCell(rownum, columnnums["Comments"], comment)
+      entries     = peakresults.Entries
+      rows        = set.Positions(peakresults.Coordinates[entries])
+      rows[rows >= 0] = set.Rows[rows[rows >= 0]]
+      order[setkey] = (entries, rows)
+      extra += numpy.count_nonzero(rows < 0)
+    # Output columns follow the last column of the data, headers first
+    output = ColumnarOutput(self.DataSource.Rows, self.DataSource.MaxColumn+1,
+                            list(options), extra)
+    output.SetHeader(options.items())
+    columnnums = output.Columns
+    # Row numbers and values of every column, in the order they are set
+    cells = {}
+    for option in columnnums: cells[option] = ([], [])
     #########################################################################
-    # Finish and write everything to the file specified by filepath
-    self.DataSource.Write(filepath=filepath)
+    # Iterate through set results and write
+    setkey = None
+    for setkey in self.Results:
+      setresults    = self.Results[setkey]
+      peakresults   = self.Results[setkey]["#PeakResults"]
+      entries, rows = order[setkey]
+      rownums       = rows.tolist()
+      comments      = [""]*len(rownums)
+      for i in numpy.flatnonzero(rows < 0):
+        index = tuple(peakresults.Coordinates[entries[i]].tolist())
+        comments[i] = "Note: A value for this peak was predicted but not found in the original data"
+        rownums[i]  = output.AddRow(self.__unobservedcells(index, setkey))
+      # Special output options, then regular peak level and set level output
+      # options, each overriding the previous ones
+      values = {"SampleGroupKey" : [setkey]*len(rownums),
+                "Comments"       : comments}
+      if(len(rownums) > 0):
+        for option in PeakResults.FIELDS:
+          values[option] = peakresults.Values(option, entries)
+      for option in setresults:
+        # All keys begining with '#' in front are skipped
+        if(option[0] == "#"): continue
+        values[option] = [setresults[option]]*len(rownums)
+      for option in columnnums:
+        if(values.has_key(option)):
+          cells[option][0].extend(rownums)
+          cells[option][1].extend(values[option])
+    #########################################################################
+    # Bad peaks get their comment and the key of the last set
+    for peak in self.BadPeaks:
+      for option, value in (("SampleGroupKey", setkey), ("Comments", peak.Comment)):
+        if(cells.has_key(option)):
+          cells[option][0].append(self.PeakRowMap[peak])
+          cells[option][1].append(value)
+    for option in cells:
+      output.Fill(option, cells[option][0], cells[option][1])
+    self.Output = output
+    return columnnums
 
   def __fillconfdefaults(self,conf): 
     if(not conf.has_key("SkipRows")):
@@ -268,39 +487,92 @@ class Analysis(DataExtractor):
       conf["Threshold"    ] = "0.99MIN"
     if(not conf.has_key("Output")):
       conf["Output"       ] = DEFAULT_OUTPUT 
+    if(not conf.has_key("Engine")):
+      conf["Engine"       ] = "numpy"
+    if(not conf.has_key("Solver")):
+      conf["Solver"       ] = "fixedpoint"
+    if(not conf.has_key("AbsoluteTolerance")):
+      conf["AbsoluteTolerance"] = 0.0
+    if(not conf.has_key("RelativeTolerance")):
+      conf["RelativeTolerance"] = 0.0
+    if(not conf.has_key("MaxIterations")):
+      conf["MaxIterations"] = None
+    if(not conf.has_key("Patience")):
+      conf["Patience"     ] = 0
+    if(not conf.has_key("Acceleration")):
+      conf["Acceleration" ] = None
+    if(not conf.has_key("Workers")):
+      conf["Workers"      ] = 1
+    if(not conf.has_key("SortedInput")):
+      conf["SortedInput"  ] = False
+    if(not conf.has_key("Sparse")):
+      conf["Sparse"       ] = False
+    if(not conf.has_key("SpillRows")):
+      conf["SpillRows"    ] = 100000
     return conf 
 
-  def __fillheaders(self):
-    options = self.Configuration["Output"]
-    columnnums = {}
-    for option in options:
-      columnname = options[option]
-      columnnums[option] = self.DataSource.MaxColumn+1
-      self.DataSource.AddCell(0, columnnums[option], columnname)
-    return columnnums  
+  def __queue(self):
+    # Enqueue all sets to run the correction analysis
+    queue = []
+    for key,set in self.PeakSets.iteritems():
+      if(len(set.Shape) == 0):
+        emsg = "Bad set with key {0}".format(str(key))
+        sys.stderr.write(emsg+"\n")
+        self.SetErrors.append(emsg)
+        continue
+      if(len(set) == 0):
+        emsg = "Zero length set with key {0}".format(str(key))
+        sys.stderr.write(emsg+"\n")
+        self.SetErrors.append(emsg)
+        continue
+      queue.append(key)
+    return queue
+
+  def __correctoroptions(self):
+    conf = self.Configuration
+    options = {"engine"       : conf["Engine"],
+               "solver"       : conf["Solver"],
+               "abstol"       : conf["AbsoluteTolerance"],
+               "reltol"       : conf["RelativeTolerance"],
+               "maxiter"      : conf["MaxIterations"],
+               "patience"     : conf["Patience"],
+               "acceleration" : conf["Acceleration"]}
+    # Solver traces are only recorded when they are written
+    if(conf.has_key("DiagnosticsFile")):
+      options["trace"] = True
+    return options
+
+  def __storeoptions(self):
+    # Options the results of a set depend on, see resultstore.ResultStore
+    options = self.__correctoroptions()
+    options["sparse"] = self.Configuration["Sparse"] and NACorrector.SPARSELIMIT
+    return options
+
+  def __restore(self, set, stored):
+    # Results of a set from the results stored for it
+    analysis = self.CorrectorPool.Get(set.LabelOrder, set.Shape,
+                                      **self.__correctoroptions())
+    analysis.Restore(stored)
+    results = analysis.FilterFormatResults(set.Threshold)
+    analysis.Release()
+    return results
 
-  def __fillunobserved(self, rownum, coordinates, setkey):
-    set = self.PeakSets[setkey]
-    # Write grouping information
+  def __unobservedcells(self, coordinates, setkey):
+    # Cells of the row of an unobserved peak, in the order they are set
+    set   = self.PeakSets[setkey]
+    cells = []
+    # Grouping information
     grouping = tuple(self.Configuration["GroupColumns"])
     for i in xrange(len(grouping)):
-      colnum = grouping[i]
-      colval = setkey[i]
-      self.DataSource.AddCell(rownum, colnum, colval)
-    # Fill in intensity column
-    colnum = self.Configuration["IntensityColumn"]
-    colval = "not observed"
-    self.DataSource.AddCell(rownum, colnum, colval)
-    # Fill in formula
-    colnum = self.Configuration["FormulaColumn"]
-    colval = set.Formula
-    self.DataSource.AddCell(rownum, colnum, colval)
-    # Fill in isotope information
+      cells.append((grouping[i], setkey[i]))
+    # Intensity column and formula
+    cells.append((self.Configuration["IntensityColumn"], "not observed"))
+    cells.append((self.Configuration["FormulaColumn"], set.Formula))
+    # Isotope information
     for i in range(len(set.LabelOrder)):
       isotope = set.LabelOrder[i]
-      colnum  = self.Configuration["IsotopeColumns"][isotope]
-      colval  = coordinates[i]
-      self.DataSource.AddCell(rownum, colnum, colval)
+      cells.append((self.Configuration["IsotopeColumns"][isotope], coordinates[i]))
+    return cells
 
   def __resolvethreshold(self, threshold):
     if(not self.Initialized):
@@ -349,6 +621,7 @@ class Analysis(DataExtractor):
     ##########################################################
     key   = self.ConstructGroupKey(data,gcols)
     peak  = self.ConstructPeak(data,intcol,iscols)
+    peak.Row = rown
     # This peak set is new, add it
     if(not self.PeakSets.has_key(key)):
       set = self.ConstructPeakSet(data,isos, fcol)
@@ -375,5 +648,5 @@ class Analysis(DataExtractor):
     except PeakError as p:
       peak.Comment = "Error: " + p.value
       self.BadPeaks.append(peak)
-    finally:
+      # Good peaks are only kept in the arrays of their set
       self.PeakRowMap[peak] = rown
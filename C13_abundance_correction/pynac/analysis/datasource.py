@@ -1,6 +1,6 @@
 #!/usr/bin/python
 # Standard Packages
-import csv
+import csv, itertools, json, os, numpy
 
 class DataSource(object):
   def __init__(self):
@@ -47,6 +47,18 @@ class CSVDataSource(DataSource):
       writer.writerow(row)
     ofile.close()
   
+  def IterRows(self, limit=0):
+    # Generator of (row number, row) that does not keep the rows in memory
+    ifile  = open(self.FilePath, "rb")
+    try:
+      reader = csv.reader(ifile)
+      for rown, row in enumerate(reader):
+        if(limit != 0 and rown == limit):
+          break
+        yield (rown, row)
+    finally:
+      ifile.close()
+
   def ReadAll(self, limit=0, subscriber=None):
     ifile  = open(self.FilePath, "rb")
     reader = csv.reader(ifile)
@@ -60,3 +72,389 @@ class CSVDataSource(DataSource):
       if(len(row) - 1 > self.MaxColumn):
         self.MaxColumn = len(row) - 1
     ifile.close() 
+
+class MemoryDataSource(CSVDataSource):
+  # Data source over rows that are already in memory (lists of strings, as
+  # read by csv.reader). The output is only written to a file if a path is
+  # given, otherwise it stays in Rows
+  def __init__(self, rows, path=None):
+    CSVDataSource.__init__(self, path)
+    self.Source = rows
+
+  def Write(self, filepath=None):
+    if(filepath == None and self.FilePath == None):
+      return
+    CSVDataSource.Write(self, filepath)
+
+  def ReadAll(self, limit=0, subscriber=None):
+    for row in self.Source:
+      row = list(row)
+      self.Rows.append(row)
+      self.MaxRow += 1
+      if(limit != 0 and self.MaxRow == limit):
+        break;
+      if(subscriber != None):
+        subscriber.OnRowRead(self.MaxRow, row)
+      if(len(row) - 1 > self.MaxColumn):
+        self.MaxColumn = len(row) - 1
+
+class ColumnarDataSource(DataSource):
+  """
+  ColumnarDataSource Object
+  =========================
+    Description
+    -----------
+    Data source in a binary columnar format: a directory (named with the
+    COLUMNAR_EXTENSION extension) holding a meta.json file and NumPy .npy
+    files. Every column is a typed array (int64, float64 or text), adjacent
+    float64 columns are stored together as one two dimensional block such
+    as an intensity matrix. The first row (the header) is kept apart, and
+    cells holding the " " padding are recorded in masks, so rows come back
+    exactly as they were written. Text that reads back as the same text is
+    stored as numbers, so chained runs exchange data without formatting or
+    parsing numbers.
+
+    Column and Matrix return memory mapped arrays without copying the data.
+    ReadAll builds the rows every analysis reads, with the header as row 0.
+
+    Example
+    -------
+    >>> source = CSVDataSource("my_data.csv")
+    >>> source.ReadAll()
+    >>> WriteColumns("my_data.columns", source.Rows)
+    >>> intensities = ColumnarDataSource("my_data.columns").Column(3)
+  """
+  def __init__(self, path):
+    DataSource.__init__(self)
+    self.FilePath = path
+    self.__meta   = None
+
+  @property
+  def Meta(self):
+    if(self.__meta is None):
+      with open(os.path.join(self.FilePath, COLUMNAR_META), "rb") as meta:
+        self.__meta = json.load(meta)
+      if(self.__meta.get("format") != COLUMNAR_FORMAT):
+        raise RuntimeError("'{0}' is not a columnar data file".format(self.FilePath))
+    return self.__meta
+
+  def Column(self, coln):
+    # Values of column coln below the header, memory mapped
+    column = self.Meta["columns"][coln]
+    array  = self.__load(column["file"])
+    if(column["index"] is not None): array = array[:, column["index"]]
+    return array
+
+  def Matrix(self, columns):
+    # Values of the columns in "columns" as a (rows, columns) array, memory
+    # mapped if they are stored together in one block
+    columns = list(columns)
+    entries = [self.Meta["columns"][coln] for coln in columns]
+    files   = set([entry["file"] for entry in entries])
+    indexes = [entry["index"] for entry in entries]
+    if(len(files) == 1 and None not in indexes and
+       indexes == range(indexes[0], indexes[0] + len(indexes))):
+      return self.__load(entries[0]["file"])[:, indexes[0]:indexes[-1]+1]
+    return numpy.column_stack([self.Column(coln) for coln in columns])
+
+  def Write(self, filepath=None):
+    if(filepath == None):
+      filepath = self.FilePath
+    WriteColumns(filepath, self.Rows)
+
+  def ReadAll(self, limit=0, subscriber=None):
+    meta    = self.Meta
+    columns = []
+    for coln in xrange(len(meta["columns"])):
+      columns.append(_decode(self.Column(coln), self.__blank(meta["columns"][coln])))
+    rows = [list(row) for row in itertools.izip(*columns)]
+    if(len(columns) == 0): rows = [[] for rown in xrange(meta["rows"])]
+    if(meta["lengths"] is not None):
+      lengths = self.__load(meta["lengths"]).tolist()
+      for rown in xrange(len(lengths)):
+        del rows[rown][lengths[rown]:]
+    if(meta["header"] is not None):
+      header = meta["header"]
+      rows.insert(0, _decode(self.__load(header["file"]), self.__blank(header)))
+    for row in rows:
+      self.Rows.append(row)
+      self.MaxRow += 1
+      if(limit != 0 and self.MaxRow == limit):
+        break;
+      if(subscriber != None):
+        subscriber.OnRowRead(self.MaxRow, row)
+      if(len(row) - 1 > self.MaxColumn):
+        self.MaxColumn = len(row) - 1
+
+  def __load(self, name):
+    return numpy.load(os.path.join(self.FilePath, name), mmap_mode="r")
+
+  def __blank(self, entry):
+    if(entry["blank"] is None): return None
+    return self.__load(entry["blank"])
+
+COLUMNAR_EXTENSION = ".columns"
+COLUMNAR_FORMAT    = "pynac columns"
+COLUMNAR_META      = "meta.json"
+
+def IsColumnar(path):
+  return os.path.splitext(path)[1].lower() == COLUMNAR_EXTENSION
+
+def WriteColumns(path, rows):
+  """
+  WriteColumns Function
+  =====================
+    Description
+    -----------
+    Writes "rows" (lists of cells, the first one being the header) to the
+    directory "path" in the format read by ColumnarDataSource. Rows may
+    have different lengths.
+  """
+  rows = [list(row) for row in rows]
+  if(not os.path.isdir(path)): os.makedirs(path)
+  meta = {"format"  : COLUMNAR_FORMAT,
+          "version" : 1,
+          "rows"    : max(len(rows) - 1, 0),
+          "header"  : None,
+          "lengths" : None,
+          "columns" : []}
+  if(len(rows) > 0):
+    meta["header"] = _save(path, "header", _encode(rows[0]))
+  body    = rows[1:]
+  lengths = [len(row) for row in body]
+  width   = max(lengths + [0])
+  if(len(set(lengths)) > 1):
+    meta["lengths"] = "lengths.npy"
+    numpy.save(os.path.join(path, "lengths.npy"), numpy.array(lengths, dtype=numpy.int64))
+  encoded = [_encode(column) for column in
+             itertools.izip_longest(*body, fillvalue=UNSET)]
+  # Adjacent float64 columns without padding are stored as one block
+  coln = 0
+  while(coln < width):
+    last = coln
+    while(last < width and encoded[last][0].dtype == numpy.float64 and
+          encoded[last][1] is None):
+      last += 1
+    if(last - coln > 1):
+      name  = "block{0}.npy".format(coln)
+      block = numpy.asfortranarray(numpy.column_stack([encoded[i][0] for i in xrange(coln, last)]))
+      numpy.save(os.path.join(path, name), block)
+      for i in xrange(coln, last):
+        meta["columns"].append({"file": name, "index": i - coln, "blank": None})
+      coln = last
+    else:
+      meta["columns"].append(_save(path, "column{0}".format(coln), encoded[coln]))
+      coln += 1
+  # The meta data is written last, a directory without it is not readable
+  with open(os.path.join(path, COLUMNAR_META), "wb") as file:
+    json.dump(meta, file, indent=1, sort_keys=True)
+
+def _save(path, name, encoded):
+  values, blank = encoded
+  entry = {"file": name + ".npy", "index": None, "blank": None}
+  numpy.save(os.path.join(path, entry["file"]), values)
+  if(blank is not None):
+    entry["blank"] = name + "_blank.npy"
+    numpy.save(os.path.join(path, entry["blank"]), blank)
+  return entry
+
+def _encode(cells):
+  # Typed array of a column and the mask of its padding cells (None if there
+  # are none). Text is only stored as numbers when it reads back the same
+  blank  = [cell is UNSET or cell == " " for cell in cells]
+  values = [cell for cell, padding in itertools.izip(cells, blank) if not padding]
+  types  = set([_kind(cls) for cls in set(map(type, values))])
+  array  = None
+  if(types == set([int])):
+    array = _typed(values, numpy.int64)
+  elif(types == set([float])):
+    array = _typed(values, numpy.float64)
+  elif(types == set([str])):
+    array = _parsed(values, numpy.int64, str)
+    if(array is None): array = _parsed(values, numpy.float64, repr)
+  if(array is None):
+    # Text, numbers as csv.writer would write them
+    values = [repr(value) if(isinstance(value, float)) else value for value in values]
+    try   : array = numpy.array([str(value) for value in values], dtype=str)
+    except UnicodeEncodeError:
+      array = numpy.array([unicode(value) for value in values], dtype=unicode)
+  if(not any(blank)): return (array, None)
+  full = numpy.zeros(len(cells), dtype=array.dtype)
+  full[~numpy.array(blank, dtype=bool)] = array
+  return (full, numpy.array(blank, dtype=bool))
+
+def _kind(cls):
+  # int, float or str for the types that can be stored typed, numpy scalars
+  # included
+  if(issubclass(cls, bool)): return object
+  if(issubclass(cls, (int, long, numpy.integer))): return int
+  if(issubclass(cls, float)): return float
+  if(cls == str): return str
+  return object
+
+def _typed(values, dtype):
+  try: return numpy.array(values, dtype=dtype)
+  except OverflowError: return None
+
+def _parsed(values, dtype, format):
+  # Text parsed as numbers, if every number formats back to the same text
+  try: array = numpy.array(values, dtype=str).astype(dtype)
+  except (ValueError, OverflowError): return None
+  if(map(format, array.tolist()) != values): return None
+  return array
+
+def _decode(array, blank):
+  # Cells of a column, padding cells are " "
+  cells = array.tolist()
+  if(blank is not None):
+    for i in numpy.flatnonzero(blank): cells[i] = " "
+  return cells
+
+# Marks the output cells that were never set
+UNSET = object()
+
+class ColumnarOutput(object):
+  """
+  ColumnarOutput Object
+  =====================
+    Description
+    -----------
+    Output columns added to the rows of a data source. Every output option
+    is one preallocated column filled by row number in bulk, and the rows
+    are only assembled when they are written. The rows come out exactly as if every
+    cell had been set with DataSource.AddCell: rows keep their own length,
+    gaps are padded with " " and the last value set for a cell wins.
+
+    Arguments
+    ---------
+      - rows    : list of rows (lists) of the data source
+      - start   : column number of the first output column
+      - options : list of output options, one column each in this order
+      - extra   : number of rows that will be appended with AddRow
+  """
+  def __init__(self, rows, start, options, extra=0):
+    self.Source  = rows
+    self.Start   = start
+    self.Columns = {}
+    for option in options:
+      self.Columns[option] = start + len(self.Columns)
+    self.Count   = len(rows)
+    self.__size  = len(rows) + extra
+    self.__extra  = []
+    self.__header = {}
+    self.__values = {}
+    self.__filled = {}
+
+  def SetHeader(self, names):
+    # Output column names, set on the first row before any value
+    self.__header = dict(names)
+
+  def AddRow(self, cells):
+    # Appends a row whose cells are given as (column, value) pairs in the
+    # order they are set, returns its row number
+    row = []
+    for coln, value in cells:
+      if(coln >= len(row)): row.extend([" "]*(coln - len(row) + 1))
+      row[coln] = value
+    self.__extra.append(row)
+    self.Count += 1
+    return self.Count - 1
+
+  def Fill(self, option, rownums, values):
+    # Sets the column of "option" at rows "rownums" to "values", in order
+    if(not self.__values.has_key(option)):
+      self.__values[option] = [UNSET]*self.__size
+    column = self.__values[option]
+    for rown, value in itertools.izip(rownums, values):
+      column[rown] = value
+
+  def IterRows(self):
+    # Generator of the output rows, unset cells are the " " padding AddCell
+    # would have added
+    width   = len(self.Columns)
+    columns = [[UNSET]*self.Count]*width
+    for option in self.__values:
+      columns[self.Columns[option] - self.Start] = self.__values[option]
+    header  = [UNSET]*width
+    for option, name in self.__header.iteritems():
+      header[self.Columns[option] - self.Start] = name
+    for rown in xrange(self.Count):
+      if(rown < len(self.Source)): row = list(self.Source[rown])
+      else                       : row = list(self.__extra[rown - len(self.Source)])
+      cells = [column[rown] for column in columns]
+      if(rown == 0):
+        cells = [header[i] if cells[i] is UNSET else cells[i] for i in xrange(width)]
+      # Number of output cells, up to the last set one
+      last = width
+      while(last > 0 and cells[last - 1] is UNSET): last -= 1
+      if(last > 0):
+        if(len(row) < self.Start): row.extend([" "]*(self.Start - len(row)))
+        if(len(row) == self.Start):
+          row.extend([" " if cell is UNSET else cell for cell in cells[:last]])
+        else:
+          # Row reaching into the output columns, set the cells one by one
+          for column in xrange(last):
+            if(cells[column] is UNSET): continue
+            coln = self.Start + column
+            if(coln >= len(row)): row.extend([" "]*(coln - len(row) + 1))
+            row[coln] = cells[column]
+      yield row
+
+  def Write(self, filepath):
+    if(IsColumnar(filepath)):
+      WriteColumns(filepath, self.IterRows())
+      return
+    ofile  = open(filepath, "wb")
+    writer = csv.writer(ofile)
+    writer.writerows(self.IterRows())
+    ofile.close()
+
+class WorkbookColumns(object):
+  """
+  WorkbookColumns Object
+  ======================
+    Description
+    -----------
+    Columns of the active sheet of an Excel workbook, read in one pass with
+    openpyxl in read only mode, so no cell objects or styles are kept. Only
+    the columns in "columns" (numbers starting at 1, as in Excel) are kept,
+    each as a numpy object array of the plain cell values, None for empty
+    cells, indexed by column number. MaxRow and MaxColumn are the
+    dimensions of the sheet, from the rows read when the workbook does not
+    record them.
+
+    Example
+    -------
+    >>> columns = WorkbookColumns("my_data.xlsx", [2, 4, 5])
+    >>> formulas = columns[2]
+  """
+  def __init__(self, filepath, columns):
+    # openpyxl is only needed to read workbooks
+    from openpyxl import load_workbook
+    columns  = sorted(set(columns))
+    values   = dict([(column, []) for column in columns])
+    workbook = load_workbook(filepath, read_only=True)
+    try:
+      sheet = workbook.active
+      # Workbooks written without a <dimension> element have no max_row or
+      # max_column in read only mode, every column is read to find them
+      known = sheet.max_row is not None and sheet.max_column is not None
+      width = 0
+      for row in sheet.iter_rows(max_col=columns[-1] if(known) else None):
+        width = max(width, len(row))
+        for column in columns:
+          if(column > len(row)): values[column].append(None)
+          else                 : values[column].append(row[column-1].value)
+      self.MaxRow    = sheet.max_row    if(known) else len(values[columns[-1]])
+      self.MaxColumn = sheet.max_column if(known) else width
+    finally:
+      # Read only workbooks keep the file open until they are closed
+      workbook.close()
+    self.Rows    = len(values[columns[-1]])
+    self.Columns = {}
+    for column in columns:
+      self.Columns[column] = numpy.empty(self.Rows, dtype=object)
+      self.Columns[column][:] = values[column]
+
+  def __getitem__(self, column):
+    return self.Columns[column]
@@ -0,0 +1,52 @@
+# Standard Packages
+import csv, numpy
+
+DIAGNOSTICS_COLUMNS = ["Sample Group Key", "Label Order", "Shape", "Isotopologues",
+                       "Iterations", "Stop Reason", "CPU Time",
+                       "Mean Iteration Time", "Max Iteration Time", "Diff Trajectory"]
+
+class SolverDiagnostics(object):
+  """
+  SolverDiagnostics Object
+  ========================
+    Description
+    -----------
+    Diagnostics of the NA correction of every group (peak set): its key,
+    label order and shape, the iterations, stop reason and CPU time of the
+    solver, the mean and largest CPU time of a solver iteration and the L1
+    difference trajectory, from before the first iteration to after the
+    last one. The traces come from the "#Trace" results of correctors made
+    with trace=True, without them only the totals are recorded. Write
+    saves one row per group, slowest groups first, with the trajectory
+    as ';' separated values.
+
+    Example
+    -------
+    >>> diagnostics = SolverDiagnostics()
+    >>> diagnostics.Add(key, set, analysis.Results[key])
+    >>> diagnostics.Write("diagnostics.csv")
+  """
+  def __init__(self):
+    self.Rows = []
+
+  def Add(self, key, set, results):
+    trace = results.get("#Trace") or {"Diffs": [], "IterationTimes": []}
+    times = trace["IterationTimes"]
+    row   = [key,
+             " ".join(set.LabelOrder),
+             "x".join([str(n) for n in set.Shape]),
+             int(numpy.prod(set.Shape)),
+             results["Iterations"],
+             results["StopReason"],
+             "%.6g" % results["CPUTime"],
+             "%.6g" % (sum(times)/len(times)) if(times) else " ",
+             "%.6g" % max(times) if(times) else " ",
+             ";".join(["%.6g" % diff for diff in trace["Diffs"]])]
+    self.Rows.append(row)
+
+  def Write(self, filepath):
+    ofile  = open(filepath, "wb")
+    writer = csv.writer(ofile)
+    writer.writerow(DIAGNOSTICS_COLUMNS)
+    writer.writerows(sorted(self.Rows, key=lambda row: -float(row[6])))
+    ofile.close()
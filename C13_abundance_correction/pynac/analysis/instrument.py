@@ -0,0 +1,76 @@
+# Standard Packages
+import os, sys, time, threading
+from collections import OrderedDict
+try              : import resource
+except ImportError: resource = None
+
+def PeakMemory():
+  # Largest resident memory of this process so far in bytes, None where the
+  # resource module is not available
+  if(resource is None): return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if(sys.platform == "darwin"): return peak
+  return peak*1024
+
+def CPUTime():
+  # CPU time of this process and of its finished child processes (the
+  # workers of mpanalysis.CorrectSets), in seconds
+  times = os.times()
+  return time.clock() + times[2] + times[3]
+
+class StageTimer(object):
+  """
+  StageTimer Object
+  =================
+    Description
+    -----------
+    Wall and CPU time, number of calls, rows and groups (peak sets) handled
+    and peak memory of named stages. A stage is timed from Start to Stop,
+    which only read the clocks so timing a stage once per peak set costs
+    a few microseconds. Report returns the totals with the throughput of
+    every stage. Stop and Report are serialized by a lock so threads can
+    share a timer.
+
+    Example
+    -------
+    >>> timer = StageTimer()
+    >>> start = timer.Start()
+    >>> do_my_stage()
+    >>> timer.Stop("MyStage", start, rows=1000)
+    >>> timer.Report()["MyStage"]["rows_per_second"]
+  """
+  def __init__(self):
+    self.Stages = OrderedDict()
+    self.__lock = threading.Lock()
+
+  def Start(self):
+    return (time.time(), CPUTime())
+
+  def Stop(self, name, start, rows=0, groups=0):
+    wall  = time.time() - start[0]
+    cpu   = CPUTime() - start[1]
+    peak  = PeakMemory()
+    with self.__lock:
+      stage = self.Stages.get(name)
+      if(stage is None):
+        stage = self.Stages[name] = {"calls" : 0, "wall" : 0.0, "cpu" : 0.0,
+                                     "rows"  : 0, "groups" : 0, "peak_memory" : None}
+      stage["calls" ] += 1
+      stage["wall"  ] += wall
+      stage["cpu"   ] += cpu
+      stage["rows"  ] += rows
+      stage["groups"] += groups
+      stage["peak_memory"] = peak
+
+  def Report(self):
+    report = OrderedDict()
+    with self.__lock:
+      stages = [(name, dict(stage)) for name, stage in self.Stages.iteritems()]
+    for name, stage in stages:
+      for count in ("rows", "groups"):
+        if(stage[count] and stage["wall"] > 0):
+          stage[count + "_per_second"] = stage[count]/stage["wall"]
+        else:
+          stage[count + "_per_second"] = None
+      report[name] = stage
+    return report
@@ -0,0 +1,66 @@
+# Standard Packages
+import multiprocessing
+# Custom Packages
+from pynac.core import isotopelabels as IsotopeLabels
+from nacache    import NACache
+from nacpool    import NACorrectorPool
+from nastore    import NATableStore
+
+# Corrector pool and corrector options of a worker process, set up by
+# _initialize when the worker starts
+_pool    = None
+_options = None
+_raw     = False
+
+def _initialize(options, store, raw=False):
+  global _pool, _options, _raw
+  if(store): store = NATableStore(store)
+  _pool    = NACorrectorPool(NACache(list(IsotopeLabels.Supported), store))
+  _options = options
+  _raw     = raw
+
+def _correct(task):
+  key, order, shape, data, threshold = task
+  corrector = _pool.Get(order, shape, **_options)
+  # Sparse tasks carry the peaks of the set instead of its dense data
+  if(isinstance(data, dict)): corrector.RunSparse(data)
+  else                      : corrector.Run(data)
+  raw     = corrector.RawResults
+  results = corrector.FilterFormatResults(threshold)
+  corrector.Release()
+  if(_raw): return (key, results, raw)
+  return (key, results)
+
+def CorrectSets(tasks, workers, options, store=None, raw=False):
+  """
+  CorrectSets Function
+  ====================
+    Description
+    -----------
+    Corrects peak sets in "workers" processes. Every task is a tuple
+    (key, label order, shape, data, threshold) and is corrected like
+    Analysis.CorrectNA would, with NACorrector keyword arguments "options".
+    Data given as a dictionary of peaks is corrected with RunSparse.
+    Only the tasks are sent to the workers: each worker builds (or, given
+    the directory "store" of a nastore.NATableStore, memory-maps) the NA
+    tables it needs and keeps its own corrector pool.
+
+    Returns
+    -------
+    A list of (key, FilterFormatResults dictionary) tuples in the order of
+    "tasks". With raw=True the tuples also hold the RawResults of the
+    corrector, e.g. to save them to a resultstore.ResultStore.
+  """
+  if(len(tasks) == 0): return []
+  workers   = min(workers, len(tasks))
+  chunksize = max(1, len(tasks)//(4*workers))
+  pool = multiprocessing.Pool(workers, _initialize, (options, store, raw))
+  try:
+    results = pool.map(_correct, tasks, chunksize)
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+  return results
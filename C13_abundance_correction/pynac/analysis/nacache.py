@@ -1,12 +1,53 @@
+# Standard Packages
+import threading, time
+from collections import OrderedDict
 # Custom Packages
 from pynac.core.nalookup import *
 from pynac.core          import isotopelabels as IsotopeLabels
+from instrument          import StageTimer
 
 class NACache(object):
-  def __init__(self, isotopes):
+  """
+  NACache Object
+  ==============
+    Description
+    -----------
+    Cache of the tables generated by nalookup.NABCTables, indexed by
+    [isotope, maximum]. Tables are built on first use (or loaded from the
+    optional nastore.NATableStore "store") and kept in least recently used
+    order. When "budget" (in bytes) is given, the least recently used tables
+    are evicted once the tables in the cache take more than "budget" bytes;
+    an evicted table is simply built again the next time it is needed. All
+    the operations are serialized by a lock so the cache can be shared by
+    threads.
+
+    Statistics holds the number of hits, misses and evictions and the total
+    time spent building tables. Timer times the calls to BuildTable.
+  """
+  def __init__(self, isotopes, store=None, budget=None):
     self.Isotopes   = isotopes
-    self.Tables     = {}
-  
+    self.Tables     = OrderedDict()
+    # Optional nastore.NATableStore the tables are loaded from
+    self.Store      = store
+    self.Budget     = budget
+    self.Size       = 0
+    self.Hits       = 0
+    self.Misses     = 0
+    self.Evictions  = 0
+    self.BuildTime  = 0.0
+    self.Timer      = StageTimer()
+    self.__lock     = threading.RLock()
+
+  @property
+  def Statistics(self):
+    with self.__lock:
+      return {"Hits"      : self.Hits,
+              "Misses"    : self.Misses,
+              "Evictions" : self.Evictions,
+              "BuildTime" : self.BuildTime,
+              "Tables"    : len(self.Tables),
+              "Size"      : self.Size}
+
   def _check2(self, isotope, max):
     if(not isinstance(isotope, str)):
       return IndexError("first index must be a string specifying an isotope symbol")
@@ -18,27 +59,53 @@ class NACache(object):
       return IndexError("isotope maximum must be an integer")
     elif(max < 1):
       return IndexError("isotope maximum must be greater than or equal to 1")
-    return None 
-    
+    return None
+
   def __getitem__(self, index):
     error = self._check2(index[0], index[1])
     if(error): raise error
-    key = index[0] + str(index[1])
-    try: return self.Tables[key]
-    except Exception as exception: raise exception
-  
+    return self.__fetch(index[0], index[1])
+
   def GetNALookup(self, maximums):
     tables = {}
     for isotope,max in maximums.iteritems():
       tables[isotope] = self[isotope, max]
     return NALookup(tables)
 
-  def BuildTable(self, isotope, max): 
+  def BuildTable(self, isotope, max):
     # TODO: throw custom exception if status != initialized
     # TODO: throw custom exception if status == finalized
     error = self._check2(isotope, max)
     if(error): raise error
+    with self.__lock:
+      start = self.Timer.Start()
+      self.__fetch(isotope, max)
+      self.Timer.Stop("BuildTable", start)
+
+  def __fetch(self, isotope, max):
     key = isotope + str(max)
-    if(not self.Tables.has_key(key)):
+    with self.__lock:
+      if(self.Tables.has_key(key)):
+        self.Hits += 1
+        tables = self.Tables.pop(key)
+        self.Tables[key] = tables
+        return tables
+      self.Misses += 1
+      start = time.time()
       na = IsotopeLabels.NA[isotope]
-      self.Tables[key] = NABCTables(max, na)
+      if(self.Store): tables = self.Store.Load(isotope, max, na)
+      else          : tables = NABCTables(max, na)
+      self.BuildTime += time.time() - start
+      self.Tables[key] = tables
+      self.Size += TablesSize(tables)
+      # Evict the least recently used tables, but never the one just built
+      while(self.Budget is not None and self.Size > self.Budget and
+            len(self.Tables) > 1):
+        evicted = self.Tables.popitem(last=False)[1]
+        self.Size -= TablesSize(evicted)
+        self.Evictions += 1
+      return tables
+
+def TablesSize(tables):
+  # Approximate memory taken by a [ptable, stable] pair, in bytes
+  return tables[0].nbytes + 8*len(tables[1])
@@ -0,0 +1,96 @@
+# Standard Packages
+import threading
+from collections import OrderedDict
+# Custom Packages
+from pynac.core.nalookup import NASumProduct, NAProduct
+from pynac.core.nacmath  import NACorrector
+from pynac.core          import isotopelabels as IsotopeLabels
+from nacache             import NACache
+
+class NACorrectorPool(object):
+  """
+  NACorrectorPool Object
+  ======================
+    Description
+    -----------
+    Pool of nacmath.NACorrector objects keyed by label order, shape, natural
+    abundance of the labels and the keyword options of the corrector. A
+    corrector (and the NA matrices, inverses and factorizations its engine
+    precomputes) is built the first time its key is requested and reused by
+    every later peak set, intensity column or file with the same key, so the
+    setup of a peak set is a dictionary lookup.
+
+    The tables are taken from the nacache.NACache "cache", by default a
+    cache of its own indexed for every supported isotope. Correctors are
+    kept in least recently used order and the least recently used ones are
+    evicted once the pool holds more than MAXCORRECTORS of them, or once
+    their lookup tables take more than the budget of the cache; an evicted
+    corrector is simply built again the next time it is needed. Get is
+    thread safe, but a corrector keeps the results of its last run so one
+    corrector must not run in two threads at the same time.
+
+    Example
+    -------
+    >>> pool = NACorrectorPool()
+    >>> corrector = pool.Get(("13C",), (7,), engine="numpy")
+    >>> corrector.Run(my_data)
+  """
+  # Largest number of correctors kept by a pool
+  MAXCORRECTORS = 256
+  def __init__(self, cache=None):
+    if(cache is None): cache = NACache(list(IsotopeLabels.Supported))
+    self.Cache      = cache
+    self.Correctors = OrderedDict()
+    self.Hits       = 0
+    self.Misses     = 0
+    self.Evictions  = 0
+    self.__lock     = threading.RLock()
+
+  @property
+  def LookupBytes(self):
+    # Memory used by the lookup tables of all the correctors in bytes, tables
+    # shared by several correctors are counted once per corrector
+    with self.__lock:
+      return sum([c.LookupBytes for c in self.Correctors.values()])
+
+  def Key(self, order, shape, options):
+    order = tuple(order)
+    na    = tuple([IsotopeLabels.NA[isotope] for isotope in order])
+    return (order, tuple(shape), na, tuple(sorted(options.items())))
+
+  def Get(self, order, shape, **options):
+    key = self.Key(order, shape, options)
+    with self.__lock:
+      if(self.Correctors.has_key(key)):
+        self.Hits += 1
+        corrector = self.Correctors.pop(key)
+        self.Correctors[key] = corrector
+        return corrector
+      self.Misses += 1
+      ptables = []
+      stables = []
+      for axis in xrange(len(order)):
+        tables = self.Cache[order[axis], shape[axis] - 1]
+        ptables.append(tables[0]) # Product Lookups
+        stables.append(tables[1]) # Sum Product Lookups
+      if(len(shape) == 1):
+        slookup = stables[0]
+        plookup = ptables[0]
+      else:
+        slookup = NASumProduct(stables)
+        plookup = NAProduct(ptables)
+      corrector = NACorrector(order, shape, slookup, plookup, **options)
+      self.Correctors[key] = corrector
+      self.__evict()
+      return corrector
+
+  def __evict(self):
+    # Evict the least recently used correctors, but never the one just built.
+    # The dense lookups of a corrector grow as it is used, so they are summed
+    # again on every eviction check
+    budget = self.Cache.Budget
+    while(len(self.Correctors) > 1 and
+          (len(self.Correctors) > NACorrectorPool.MAXCORRECTORS or
+           (budget is not None and self.LookupBytes > budget))):
+      self.Correctors.popitem(last=False)
+      self.Evictions += 1
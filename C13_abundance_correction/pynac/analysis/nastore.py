@@ -0,0 +1,116 @@
+# Standard Packages
+import os, tempfile, numpy
+from numbers import Integral
+# Custom Packages
+from pynac.core.nalookup import NABCTables
+
+class PackedTable(object):
+  """
+  PackedTable Object
+  ==================
+    Description
+    -----------
+    Read-only view of a binomial coefficient product table (the first table
+    of nalookup.NABCTables) stored as its packed upper triangle, row after
+    row. Entries below the diagonal are zero. Indexing with [n,k] reads a
+    single entry, [rows,k] (a slice of rows) reads the rows of column k as
+    an array and numpy.asarray() unpacks the full square table. Any other
+    index raises a TypeError.
+  """
+  def __init__(self, packed, size):
+    self.__packed = packed
+    self.__size   = size
+
+  @property
+  def shape(self):
+    return (self.__size, self.__size)
+
+  @property
+  def nbytes(self):
+    return self.__packed.nbytes
+
+  def __len__(self):
+    return self.__size
+
+  def __getitem__(self, index):
+    n, k = index
+    if(not isinstance(k, Integral)):
+      raise TypeError("PackedTable column index must be an integer")
+    if(isinstance(n, slice)): return self.__column(k)[n]
+    if(not isinstance(n, Integral)):
+      raise TypeError("PackedTable row index must be an integer or a slice")
+    if(k < n): return 0.0
+    return float(self.__packed[n*(2*self.__size - n + 1)//2 + k - n])
+
+  def __column(self, k):
+    # Column k of the table, the entries of the rows n <= k are packed
+    size = self.__size
+    if(k < 0): k += size
+    if(k < 0 or k >= size): raise IndexError("PackedTable column index out of range")
+    rows   = numpy.arange(k + 1)
+    column = numpy.zeros(size, dtype=float)
+    column[rows] = self.__packed[rows*(2*size - rows + 1)//2 + k - rows]
+    return column
+
+  def __array__(self, dtype=None):
+    table = numpy.zeros(self.shape, dtype=float)
+    table[numpy.triu_indices(self.__size)] = self.__packed
+    if(dtype is not None): table = table.astype(dtype)
+    return table
+
+class NATableStore(object):
+  """
+  NATableStore Object
+  ===================
+    Description
+    -----------
+    Persistent store of the tables generated by nalookup.NABCTables, kept in
+    the directory "directory" and keyed by isotope, isotope maximum and
+    natural abundance. Every table is one .npy file holding the packed upper
+    triangle of the product table followed by the sum product table. Files
+    are loaded memory-mapped and read only, so repeated runs and concurrent
+    processes share them instead of building or copying them. A missing or
+    unreadable file is built and written atomically on first use.
+  """
+  def __init__(self, directory):
+    self.Directory = directory
+    if(not os.path.isdir(directory)):
+      try: os.makedirs(directory)
+      except OSError:
+        if(not os.path.isdir(directory)): raise
+
+  def Path(self, isotope, max, na):
+    name = "{0}_{1}_{2}.npy".format(isotope, int(max), repr(float(na)))
+    return os.path.join(self.Directory, name)
+
+  def Load(self, isotope, max, na):
+    size   = int(max) + 1
+    path   = self.Path(isotope, max, na)
+    packed = self.__read(path, size)
+    if(packed is None):
+      self.Save(isotope, max, na, NABCTables(int(max), na))
+      packed = self.__read(path, size)
+    triangle = size*(size + 1)//2
+    return [PackedTable(packed[:triangle], size), packed[triangle:]]
+
+  def Save(self, isotope, max, na, tables):
+    ptable = numpy.asarray(tables[0], dtype=float)
+    packed = numpy.concatenate((ptable[numpy.triu_indices(len(ptable))],
+                                numpy.asarray(tables[1], dtype=float)))
+    path = self.Path(isotope, max, na)
+    # Write to a temporary file and rename it so readers never see a
+    # partially written table
+    handle, temporary = tempfile.mkstemp(suffix=".tmp", dir=self.Directory)
+    try:
+      with os.fdopen(handle, "wb") as file:
+        numpy.save(file, packed)
+      os.rename(temporary, path)
+    finally:
+      if(os.path.exists(temporary)): os.remove(temporary)
+
+  def __read(self, path, size):
+    if(not os.path.exists(path)): return None
+    try: packed = numpy.load(path, mmap_mode="r")
+    except (IOError, ValueError): return None
+    if(packed.shape != (size*(size + 1)//2 + size,)): return None
+    return packed
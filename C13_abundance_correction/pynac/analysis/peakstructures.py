@@ -2,10 +2,28 @@
 # Standard Packages
 import re
 import math
+from array import array
+import numpy
 # Custom Packages
 from pynac.core import isotopelabels as IsotopeLabels
 
 class PeakSet(object):
+  """
+  PeakSet Object
+  ==============
+    Description
+    -----------
+    The peaks of one molecule (sample group). The peaks are not kept as Peak
+    objects but in flat arrays, in the order they were added: the isotope
+    counts of LabelOrder (Coordinates), the intensities (Intensities) and
+    the source row numbers (Rows, -1 when unknown), with a dictionary from
+    the flat index of the coordinates to the position of the peak for the
+    duplicate check. RawSet and RawData build the dictionaries of earlier
+    versions from the arrays on every access.
+
+    AddPeak validates and adds a single peak, AddPeaks validates many peaks
+    at once over arrays, both raise or return the same PeakErrors.
+  """
   PTRegEx = re.compile("(?P<percent>0*.\d+)(?P<statistic>MAX|MIN|AVG)")
   def __init__(self, maximums, formula):
     self.__maximums  = maximums
@@ -15,16 +33,22 @@ class PeakSet(object):
         self.__order.append(m)
     self.__order     = tuple(self.__order)
     self.__shape     = tuple(map(lambda i: maximums[i]+1, self.__order))
-    self.__peaks     = {}
+    self.__strides   = tuple([int(numpy.prod(self.__shape[i+1:])) for i in xrange(len(self.__shape))])
     self.__formula   = formula
-    self.__rawdata   = {}
+    self.__coords    = array('l')
+    self.__values    = array('d')
+    self.__rows      = array('l')
+    self.__positions = {}
     self.__threshold = float('inf')
     self.__minpeak   = None
     self.__maxpeak   = None
     self.__sum       = 0
   
   def __len__(self):
-    return len(self.__peaks)
+    return len(self.__values)
+
+  def __contains__(self, index):
+    return self.__key(index) in self.__positions
   
   @property
   def Formula(self):
@@ -36,11 +60,19 @@ class PeakSet(object):
     
   @property
   def RawSet(self):
-    return self.__peaks
+    # Dictionary from coordinates to Peak objects, with the isotope counts
+    # of LabelOrder only, built on every access
+    rawset = {}
+    for position in xrange(len(self)):
+      index = self.__index(position)
+      peak  = Peak(self.__values[position], dict(zip(self.__order, index)))
+      peak.Row = self.Row(index)
+      rawset[index] = peak
+    return rawset
   
   @property
   def TotalPeaks(self):
-    return len(self.__peaks)
+    return len(self)
   
   @property
   def LabelOrder(self):
@@ -48,7 +80,25 @@ class PeakSet(object):
   
   @property
   def RawData(self):
-    return self.__rawdata
+    # Dictionary from coordinates to intensities, built on every access
+    rawdata = {}
+    for position in xrange(len(self)):
+      rawdata[self.__index(position)] = self.__values[position]
+    return rawdata
+
+  @property
+  def Coordinates(self):
+    # Coordinates of the peaks, one row per peak
+    coordinates = numpy.array(self.__coords, dtype=int)
+    return coordinates.reshape((len(self), len(self.__order)))
+
+  @property
+  def Intensities(self):
+    return numpy.array(self.__values, dtype=float)
+
+  @property
+  def Rows(self):
+    return numpy.array(self.__rows, dtype=int)
     
   @property
   def MaximumPeak(self):
@@ -84,56 +134,168 @@ class PeakSet(object):
   def Threshold(self, value):
     # TODO: Input hardening (string validation, type checking)
     self.__threshold = value
+
+  def Row(self, index):
+    # Source row number of the peak at coordinates "index", None if the set
+    # has no such peak or its row is unknown
+    position = self.__positions.get(self.__key(index))
+    if(position is None or self.__rows[position] < 0): return None
+    return self.__rows[position]
+  
+  def Positions(self, coordinates):
+    # Positions of the peaks at the rows of the array "coordinates", -1 for
+    # the ones the set does not have
+    shape   = numpy.array(self.__shape, dtype=int)
+    strides = numpy.array(self.__strides, dtype=int)
+    coordinates = numpy.asarray(coordinates, dtype=int).reshape((-1, len(shape)))
+    own     = self.Coordinates
+    owned   = numpy.flatnonzero(((own >= 0) & (own < shape)).all(axis=1))
+    flat    = own[owned].dot(strides)
+    sort    = numpy.argsort(flat, kind="mergesort")
+    flat    = flat[sort]
+    inside  = ((coordinates >= 0) & (coordinates < shape)).all(axis=1)
+    wanted  = coordinates.dot(strides)
+    found   = numpy.minimum(numpy.searchsorted(flat, wanted), max(len(flat) - 1, 0))
+    positions = numpy.full(len(coordinates), -1, dtype=int)
+    if(len(flat) == 0): return positions
+    hits    = inside & (flat[found] == wanted)
+    positions[hits] = owned[sort[found[hits]]]
+    return positions
+
+  def __key(self, index):
+    # Flat index of the coordinates, the coordinates themselves when a count
+    # is out of the shape and there is no flat index
+    key = 0
+    for count, size, stride in zip(index, self.__shape, self.__strides):
+      if(count < 0 or count >= size): return tuple(index)
+      key += count*stride
+    return key
+
+  def __index(self, position):
+    dims = len(self.__order)
+    return tuple(self.__coords[position*dims:(position+1)*dims])
+
+  def __duplicate(self, peak):
+    e1msg = "duplicated: peak set already contains peak for isotope counts "
+    for isotope, count in peak.IsotopeCounts.iteritems():
+      e1msg += "{0} {1}, ".format(count, IsotopeLabels.Name[isotope])
+    return PeakError(e1msg.strip(','))
+
+  def __abovemaximum(self, isotope):
+    e3msg = "isotope count for {0} above molecule's count for {1}" 
+    return PeakError(e3msg.format(IsotopeLabels.Name[isotope],
+                                  IsotopeLabels.Element[isotope]))
   
   def __checkpeak(self, peak, index):
     #Peak already in set, must be a duplicate
-    if(self.__peaks.has_key(index)):
-      e1msg = "duplicated: peak set already contains peak for isotope counts "
-      for isotope, count in peak.IsotopeCounts.iteritems():
-        e1msg += "{0} {1}, ".format(count, IsotopeLabels.Name[isotope])
-      return PeakError(e1msg.strip(','))
+    if(self.__key(index) in self.__positions):
+      return self.__duplicate(peak)
     #Isotope count errors
     for isotope in self.__order:
       name    = IsotopeLabels.Name[isotope]
-      element = IsotopeLabels.Element[isotope]
       #No count for expected isotope label 
-      if(isotope not in peak.IsotopeCounts):
+      if(peak.GetIsotopeCount(isotope) is None):
         e2msg = "peak contains no isotope count for {0}"
         return PeakError(e2msg.format(name))
       #Count for a label greater than molecule's max for label's element
-      if(peak.IsotopeCounts[isotope] > self.__maximums[isotope]):
-        e3msg = "isotope count for {0} above molecule's count for {1}" 
-        return PeakError(e3msg.format(name,element))
+      if(peak.GetIsotopeCount(isotope) > self.__maximums[isotope]):
+        return self.__abovemaximum(isotope)
     return False
   
   def __buildindex(self, peak):
     index = []
     for isotope in self.__order:
-      index.append(peak.IsotopeCounts[isotope])
+      count = peak.GetIsotopeCount(isotope)
+      if(count is None): raise KeyError(isotope)
+      index.append(count)
     return tuple(index)
   
   def IsotopeMaximum(self, isotope):
     return self.__maximums[isotope]
+
+  def __append(self, peak, index, key):
+    self.__positions[key] = len(self.__values)
+    self.__coords.extend(index)
+    self.__values.append(peak.Intensity)
+    self.__rows.append(-1 if(peak.Row is None) else peak.Row)
+    if(peak.Intensity != 0):
+      self.__sum += peak.Intensity
+      if(self.MinimumPeak == None or peak < self.MinimumPeak):
+        self.__minpeak = peak
+      if(self.MaximumPeak == None or peak > self.MaximumPeak):
+        self.__maxpeak = peak   
   
   def AddPeak(self, peak):
     index = self.__buildindex(peak)
     error = self.__checkpeak(peak,index)
     if(not error):
-      self.__peaks[index]   = peak
-      self.__rawdata[index] = peak.Intensity
-      if(peak.Intensity != 0):
-        self.__sum += peak.Intensity
-        if(self.MinimumPeak == None or peak < self.MinimumPeak):
-          self.__minpeak = peak
-        if(self.MaximumPeak == None or peak > self.MaximumPeak):
-          self.__maxpeak = peak   
+      self.__append(peak, index, self.__key(index))
     else: raise error
-    
+
+  def AddPeaks(self, peaks):
+    """
+    AddPeaks Function
+    =================
+      Description
+      -----------
+      Adds the peaks of the list "peaks" in order, like one AddPeak each,
+      checking all of them for duplicates and counts above the maximums
+      with array operations.
+
+      Returns
+      -------
+      A list with the PeakError of every peak that was not added, None for
+      the ones that were.
+    """
+    indexes = [self.__buildindex(peak) for peak in peaks]
+    dims    = len(self.__order)
+    counts  = numpy.array(indexes, dtype=int).reshape((len(peaks), dims))
+    if((counts < 0).any()):
+      # No flat index, one peak at a time
+      errors = []
+      for peak in peaks:
+        try:
+          self.AddPeak(peak)
+          errors.append(None)
+        except PeakError as p:
+          errors.append(p)
+      return errors
+    maximums = numpy.array(self.__shape, dtype=int) - 1
+    above    = counts > maximums
+    flat     = counts.dot(numpy.array(self.__strides, dtype=int))
+    # Duplicates of a peak of the set or of an earlier peak of the list,
+    # peaks above the maximums are never added so they duplicate nothing
+    first    = numpy.zeros(len(peaks), dtype=bool)
+    inrange  = numpy.flatnonzero(~above.any(axis=1))
+    where    = numpy.unique(flat[inrange], return_index=True)[1]
+    first[inrange[where]] = True
+    if(self.__positions):
+      first[inrange] &= ~numpy.in1d(flat[inrange], numpy.array(self.__positions.keys()))
+    errors = []
+    for p in xrange(len(peaks)):
+      if(first[p]):
+        self.__append(peaks[p], indexes[p], int(flat[p]))
+        errors.append(None)
+      elif(not above[p].any()):
+        errors.append(self.__duplicate(peaks[p]))
+      else:
+        errors.append(self.__abovemaximum(self.__order[numpy.flatnonzero(above[p])[0]]))
+    return errors
+
+# Label tuples shared by the peaks with the same labels
+_LABELS = {}
+
 class Peak(object):
-  def __init__(self, intensity, isocounts):
+  # One intensity with its isotope counts, the counts are kept as tuples
+  # (the labels shared by all peaks) so a peak takes little memory
+  __slots__ = ("_Peak__intensity", "_Peak__labels", "_Peak__counts", "Comment", "Row")
+  def __init__(self, intensity, isocounts, row=None):
+    labels = tuple(isocounts)
     self.__intensity = intensity
-    self.__isotopecounts = isocounts  
+    self.__labels    = _LABELS.setdefault(labels, labels)
+    self.__counts    = tuple([isocounts[label] for label in labels])
     self.Comment = ""
+    self.Row     = row
     
   @property
   def Intensity(self):
@@ -141,14 +303,17 @@ class Peak(object):
   
   @property
   def IsotopeCounts(self):
-    return self.__isotopecounts
+    counts = {}
+    for label, count in zip(self.__labels, self.__counts):
+      counts[label] = count
+    return counts
  
   def GetIsotopeCount(self,isotope):
-    try            : return self.__isotopecounts[isotope]
-    except KeyError: return None
+    try              : return self.__counts[self.__labels.index(isotope)]
+    except ValueError: return None
 
   def copy(self):
-    copy = Peak(self.Intensity, self.IsotopeCounts)
+    copy = Peak(self.Intensity, self.IsotopeCounts, self.Row)
     copy.Comment = self.Comment
     return copy
 
@@ -0,0 +1,94 @@
+# Standard Packages
+import os, tempfile, hashlib, cPickle, numpy
+# Custom Packages
+from pynac.core import isotopelabels as IsotopeLabels
+
+class ResultStore(object):
+  """
+  ResultStore Object
+  ==================
+    Description
+    -----------
+    Persistent store of the results of NACorrector.Run (or RunSparse) of
+    peak sets, kept in the directory "directory" as one pickle file per set.
+    Results are keyed by a hash of everything they depend on: RESULTVERSION,
+    the label order and shape of the set, the natural abundances of the
+    labels, the corrector options and the non zero intensities of the set.
+    Analysis looks sets up before correcting them, so a set that did not
+    change since an earlier run is served from the store with the
+    iterations and CPU time of the run that stored it. Thresholds are
+    applied afterwards and are not part of the key. A missing or unreadable
+    file is a miss, files are written atomically. Hits and Misses count the
+    lookups.
+
+    Load unpickles the files of the directory, and unpickling can run
+    arbitrary code, so the directory must only be writable by trusted users.
+
+    Example
+    -------
+    >>> store = ResultStore("results")
+    >>> key = store.Key(set, {"engine" : "numpy"})
+    >>> results = store.Load(key)
+  """
+  # Version of the stored results, to be increased whenever the solvers or
+  # the results they store change so that older results are not served
+  RESULTVERSION = 1
+  def __init__(self, directory):
+    self.Directory = directory
+    self.Hits      = 0
+    self.Misses    = 0
+    if(not os.path.isdir(directory)):
+      try: os.makedirs(directory)
+      except OSError:
+        if(not os.path.isdir(directory)): raise
+
+  @property
+  def Statistics(self):
+    lookups = self.Hits + self.Misses
+    return {"Hits"    : self.Hits,
+            "Misses"  : self.Misses,
+            "HitRate" : float(self.Hits)/lookups if(lookups) else None}
+
+  def Key(self, set, options):
+    # Hash of the peak set "set" corrected with the options "options", the
+    # peaks are hashed in the order of their coordinates
+    order   = set.LabelOrder
+    digest  = hashlib.sha1(repr((ResultStore.RESULTVERSION, order, set.Shape,
+                                 [IsotopeLabels.NA[label] for label in order],
+                                 sorted(options.items()))))
+    intensities = set.Intensities
+    observed    = numpy.flatnonzero(intensities != 0)
+    coordinates = set.Coordinates[observed]
+    sort        = numpy.lexsort(coordinates.T[::-1])
+    digest.update(numpy.ascontiguousarray(coordinates[sort], dtype=numpy.int64).tostring())
+    digest.update(numpy.ascontiguousarray(intensities[observed][sort], dtype=numpy.float64).tostring())
+    return digest.hexdigest()
+
+  def Path(self, key):
+    return os.path.join(self.Directory, key + ".pkl")
+
+  def Load(self, key):
+    # Stored results of "key", None if there are none
+    results = None
+    try:
+      with open(self.Path(key), "rb") as file:
+        results = cPickle.load(file)
+    except (IOError, EOFError, ValueError, TypeError, AttributeError,
+            ImportError, IndexError, cPickle.UnpicklingError):
+      results = None
+    if(not isinstance(results, dict)):
+      self.Misses += 1
+      return None
+    self.Hits += 1
+    return results
+
+  def Save(self, key, results):
+    # Write to a temporary file and rename it so readers never see partially
+    # written results
+    handle, temporary = tempfile.mkstemp(suffix=".tmp", dir=self.Directory)
+    try:
+      with os.fdopen(handle, "wb") as file:
+        cPickle.dump(results, file, cPickle.HIGHEST_PROTOCOL)
+      os.rename(temporary, self.Path(key))
+    finally:
+      if(os.path.exists(temporary)): os.remove(temporary)
@@ -0,0 +1,193 @@
+# Standard Packages
+import csv, heapq, itertools, os, sys, tempfile
+# Custom Packages
+from datasource     import CSVDataSource
+from analysis       import Analysis
+from diagnostics    import SolverDiagnostics
+
+UNOBSERVED_COMMENT = "Note: A value for this peak was predicted but not found in the original data"
+
+class StreamingAnalysis(Analysis):
+  """
+  StreamingAnalysis Object
+  ========================
+    Description
+    -----------
+    Analysis of a CSV data file that never holds more than one peak set in
+    memory. Rows are read one at a time, grouped by the GroupColumns, every
+    group is corrected as soon as it is complete and its rows are written
+    right away, followed by the rows of its unobserved peaks whose predicted
+    values are above threshold.
+
+    The rows of a group must be contiguous. Unless the SortedInput option
+    is set, the rows are first sorted by group with an external merge sort
+    that spills runs of SpillRows rows to temporary files, so the groups come
+    out in key order. The rows in SkipRows are written first, unchanged
+    except for the output headers added to the first row. The output columns
+    follow the last column of the first row, so no row may be wider than the
+    first one. Global thresholds (GMAX, GMIN, GAVG, GAMAX, GAMIN) need all
+    the data and are not supported.
+
+    Example
+    -------
+    >>> analysis = StreamingAnalysis()
+    >>> analysis.ConfigureFromFile("my_config.txt")
+    >>> analysis.Run()
+  """
+  def Run(self, filepath=None):
+    self.CheckConfiguration()
+    conf = self.Configuration
+    if(filepath == None and not conf.has_key("OutputFile")):
+      raise RuntimeError("No output file specified")
+    elif(filepath == None):
+      filepath = conf["OutputFile"]
+    if(not conf.has_key("DataFile")):
+      raise RuntimeError("No data source has been specified")
+    if(Analysis.PTRegEx.match(str(conf["Threshold"]))):
+      raise RuntimeError("Global thresholds are not supported when streaming")
+    start = self.Timer.Start()
+    self.InitializeCaches()
+    self.Initialized = True
+    source = CSVDataSource(conf["DataFile"])
+    ofile  = open(filepath, "wb")
+    nrows   = 0
+    ngroups = 0
+    self.__diagnostics = None
+    if(conf.has_key("DiagnosticsFile")): self.__diagnostics = SolverDiagnostics()
+    try:
+      self.__writer = csv.writer(ofile)
+      rows = self.__skiprows(source.IterRows())
+      if(not conf["SortedInput"]): rows = self.__sort(rows)
+      for key, group in itertools.groupby(rows, lambda row: row[0]):
+        group = [row[2] for row in group]
+        self.__correctgroup(key, group)
+        nrows   += len(group)
+        ngroups += 1
+    finally:
+      ofile.close()
+    self.Timer.Stop("Run", start, rows=nrows, groups=ngroups)
+    if(conf.has_key("ReportFile")): self.WriteReport(conf["ReportFile"])
+    if(self.__diagnostics is not None):
+      self.__diagnostics.Write(conf["DiagnosticsFile"])
+
+  def __skiprows(self, rows):
+    # Writes the skipped rows (with the output headers on the first one)
+    # and yields (key, row number, row) for the others
+    skip   = self.Configuration["SkipRows"]
+    gcols  = self.Configuration["GroupColumns"]
+    output = self.Configuration["Output"]
+    self.__width = None
+    for rown, row in rows:
+      if(self.__width is None):
+        # Output columns follow the first row, in the order WriteOutput
+        # would add them
+        self.__width   = len(row)
+        self.__columns = {}
+        for option in output:
+          self.__columns[option] = self.__width + len(self.__columns)
+        if(rown in skip):
+          row = row + [output[option] for option in output]
+      if(rown in skip):
+        self.__writer.writerow(row)
+        continue
+      if(len(row) > self.__width):
+        raise RuntimeError("Row {0} is wider than the first row".format(rown))
+      yield (self.ConstructGroupKey(row, gcols), rown, row)
+
+  def __sort(self, rows):
+    # External merge sort of (key, row number, row) by key, runs of
+    # SpillRows rows are sorted in memory and spilled to temporary files
+    size  = self.Configuration["SpillRows"]
+    runs  = []
+    paths = []
+    try:
+      while(True):
+        run = list(itertools.islice(rows, size))
+        if(len(run) == 0): break
+        run.sort()
+        if(len(run) < size and len(runs) == 0):
+          # Everything fits in memory, nothing to spill
+          for row in run: yield row
+          return
+        handle, path = tempfile.mkstemp(suffix=".csv")
+        paths.append(path)
+        with os.fdopen(handle, "wb") as spill:
+          writer = csv.writer(spill)
+          for key, rown, row in run: writer.writerow([rown] + row)
+        runs.append(self.__readrun(path))
+      for row in heapq.merge(*runs): yield row
+    finally:
+      for path in paths:
+        if(os.path.exists(path)): os.remove(path)
+
+  def __readrun(self, path):
+    gcols = self.Configuration["GroupColumns"]
+    with open(path, "rb") as spill:
+      for row in csv.reader(spill):
+        yield (self.ConstructGroupKey(row[1:], gcols), int(row[0]), row[1:])
+
+  def __correctgroup(self, key, rows):
+    conf    = self.Configuration
+    fcol    = conf["FormulaColumn"  ]
+    isos    = conf["IsotopeColumns" ].keys()
+    iscols  = conf["IsotopeColumns" ]
+    intcol  = conf["IntensityColumn"]
+    set     = self.ConstructPeakSet(rows[0], isos, fcol)
+    set.Threshold = conf["Threshold"]
+    peaks   = [self.ConstructPeak(row, intcol, iscols) for row in rows]
+    bad     = []
+    for peak, error in zip(peaks, set.AddPeaks(peaks)):
+      if(error is not None): peak.Comment = "Error: " + error.value
+      bad.append(error is not None)
+    results = None
+    if(len(set.Shape) == 0):
+      emsg = "Bad set with key {0}".format(str(key))
+      sys.stderr.write(emsg+"\n")
+      self.SetErrors.append(emsg)
+    elif(len(set) == 0):
+      emsg = "Zero length set with key {0}".format(str(key))
+      sys.stderr.write(emsg+"\n")
+      self.SetErrors.append(emsg)
+    else:
+      results = self.CheckResults(key, self.CorrectNA(set))
+      if(self.__diagnostics is not None):
+        self.__diagnostics.Add(key, set, results)
+    # Rows of the group, in input order
+    for row, peak, error in zip(rows, peaks, bad):
+      row = row + [" "]*(self.__width + len(self.__columns) - len(row))
+      if(error):
+        self.__fillcells(row, key, peak.Comment)
+      elif(results is not None):
+        coordinates = tuple([peak.GetIsotopeCount(isotope) for isotope in set.LabelOrder])
+        if(results["#PeakResults"].has_key(coordinates)):
+          self.__fillcells(row, key, peak.Comment, results,
+                           results["#PeakResults"][coordinates])
+      self.__writer.writerow(row)
+    if(results is None): return
+    # Rows of the unobserved peaks predicted above threshold, in the order of
+    # the entries as with Analysis.WriteOutput
+    peaks = results["#PeakResults"]
+    for coordinates in peaks.Keys():
+      if(coordinates in set): continue
+      row = [" "]*(self.__width + len(self.__columns))
+      gcols = conf["GroupColumns"]
+      for i in xrange(len(gcols)):
+        row[gcols[i]] = key[i]
+      row[intcol] = "not observed"
+      row[fcol]   = set.Formula
+      for i in xrange(len(set.LabelOrder)):
+        row[iscols[set.LabelOrder[i]]] = coordinates[i]
+      self.__fillcells(row, key, UNOBSERVED_COMMENT, results, peaks[coordinates])
+      self.__writer.writerow(row)
+
+  def __fillcells(self, row, key, comment, results=None, peakresults=None):
+    columns = self.__columns
+    if(columns.has_key("SampleGroupKey")): row[columns["SampleGroupKey"]] = key
+    if(columns.has_key("Comments")): row[columns["Comments"]] = comment
+    if(results is None): return
+    for option in peakresults:
+      if(columns.has_key(option)): row[columns[option]] = peakresults[option]
+    for option in results:
+      # All keys begining with '#' in front are skipped
+      if(option[0] == "#"): continue
+      if(columns.has_key(option)): row[columns[option]] = results[option]
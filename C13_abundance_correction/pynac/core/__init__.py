@@ -1 +1 @@
-__all__ = ["isotopelabels", "nacmath", "naciter", "nalookup"]
+__all__ = ["isotopelabels", "nacmath", "naciter", "nalookup", "naengine", "naresults"]
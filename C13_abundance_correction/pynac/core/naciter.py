@@ -1,3 +1,7 @@
+import threading
+from collections import OrderedDict
+import numpy
+
 class MDIter(object):
   def __init__(self, dimensions, start, stop, sign):
     self._dims    = dimensions
@@ -36,7 +40,7 @@ class UltimateNACIter(NACIter):
       axis += 1
       current[axis] += step
     
-    if(current[last]*sign >= stop[axis]*sign):
+    if(current[last]*sign >= stop[last]*sign):
       raise StopIteration
 
     return tuple(current)
@@ -114,3 +118,67 @@ class ExtendedNACIter(MDIter):
     if((current[last] - stop[last])*sign > 0):
       raise StopIteration
     return tuple(current)
+
+class NACPlan(object):
+  """
+  NACPlan Object
+  ==============
+    Description
+    -----------
+    Precomputed iteration of a shape, built once per shape by GetNACPlan and
+    shared by every corrector of that shape.
+
+      Coordinates : list of the coordinate tuples in the order of
+                    UltimateNACIter(shape). Built the first time it is used.
+      Flat        : numpy array of the flat (C order) indices of Coordinates
+      Steps       : list of (y, box) for every y of Coordinates, box being
+                    the tuple of slices of the coordinates x <= y (on every
+                    axis), so array[box] gathers the x of PenultimateNACIter(y)
+                    and y itself at once. Their order is the Fortran order of
+                    the box, y last. Built the first time it is used.
+
+    Example
+    -------
+    >>> plan = GetNACPlan((3, 2))
+    >>> plan.Select(data > 0)
+  """
+  def __init__(self, shape):
+    self.Shape         = tuple(shape)
+    # UltimateNACIter runs over the shape with the first axis fastest, the
+    # Fortran order
+    size               = int(numpy.prod(self.Shape))
+    self.Flat          = numpy.arange(size).reshape(self.Shape).ravel(order="F")
+    self.__coordinates = None
+    self.__steps       = None
+
+  @property
+  def Coordinates(self):
+    if(self.__coordinates is None):
+      self.__coordinates = list(UltimateNACIter(self.Shape))
+    return self.__coordinates
+
+  @property
+  def Steps(self):
+    if(self.__steps is None):
+      self.__steps = [(y, tuple([slice(0, c + 1) for c in y]))
+                      for y in self.Coordinates]
+    return self.__steps
+
+  def Select(self, mask):
+    # Coordinates where the boolean array "mask" of the plan shape is True
+    coordinates = self.Coordinates
+    return [coordinates[i] for i in numpy.flatnonzero(numpy.ravel(mask)[self.Flat])]
+
+# Cached plans in least recently used order, at most _MAXPLANS of them
+_PLANS    = OrderedDict()
+_MAXPLANS = 64
+_LOCK     = threading.Lock()
+def GetNACPlan(shape):
+  # Cached NACPlan of "shape"
+  shape = tuple(shape)
+  with _LOCK:
+    plan = _PLANS.pop(shape, None)
+    if(plan is None): plan = NACPlan(shape)
+    _PLANS[shape] = plan
+    if(len(_PLANS) > _MAXPLANS): _PLANS.popitem(last=False)
+  return plan
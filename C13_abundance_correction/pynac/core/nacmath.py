@@ -5,7 +5,18 @@ import numpy
 # Custom Packages
 import isotopelabels as IsotopeLabels
 import naciter       as NI 
-from   nalookup      import NASumProduct,NAProduct
+from   nalookup      import NASumProduct,NAProduct,NAnDLookup
+from   naengine      import TriangularNAEngine,KroneckerNAEngine,NAMatrix,NNLS
+from   naengine      import SparseNAEngine,SupportCoordinates
+from   naengine      import AndersonAccelerator
+from   naresults     import PeakResults
+
+# Supported correction engines
+ENGINES = ("numpy", "python")
+# Supported solvers
+SOLVERS = ("fixedpoint", "nnls")
+# Supported accelerations of the fixedpoint solver
+ACCELERATIONS = (None, "anderson")
 
 class NACorrector(object):
   """
@@ -35,7 +46,17 @@ class NACorrector(object):
     >>> my_analaysis.Run(my_data) # my_data must have the same shape as my_shape
     >>> my_results_dictionary = my_analysis.FilterFormatResults()    
   """
-  def __init__(self, order, shape, slookup=None, plookup=None):
+  # Largest number of isotopologues the nnls solver will build a dense
+  # NA matrix for
+  NNLSLIMIT = 4096
+  # Largest number of isotopologues RunSparse corrects with a support NA
+  # matrix, larger supports are corrected densely
+  SPARSELIMIT = 2048
+  # Number of previous iterates used by the anderson acceleration
+  ANDERSONDEPTH = 3
+  def __init__(self, order, shape, slookup=None, plookup=None, engine="numpy",
+               solver="fixedpoint", abstol=0.0, reltol=0.0, maxiter=None,
+               patience=0, acceleration=None, trace=False):
     """
     NACorrector Constructor
     =======================
@@ -65,8 +86,46 @@ class NACorrector(object):
         - plookup : NAProduct object to be used by this correction algorithm.
                     If it is not supplied it will be generated based on the
                     arguments "order" and "shape".                    
+        - engine  : string specifying how SubtractNA, AddNA and
+                    ReplaceNegatives are computed. "numpy" (default) uses the
+                    vectorized engines of the pynac.core.naengine module,
+                    "python" uses the original element by element loops.
+        - solver  : string specifying how Run removes natural abundance.
+                    "fixedpoint" (default) alternates SubtractNA and AddNA
+                    passes with RemoveNA, "nnls" solves the non-negative
+                    least squares problem min ||M.x - data|| with x >= 0
+                    directly with SolveNNLS, where M is the NA matrix.
+                    Shapes with more than NNLSLIMIT isotopologues are
+                    corrected with the "fixedpoint" solver instead, see the
+                    "Fallback" result of Run.
+        - abstol  : float, the fixedpoint solver stops once an iteration
+                    improves the L1 difference between the data and the
+                    predicted intensities by no more than abstol. Default 0.
+        - reltol  : float, same as abstol but relative to the best
+                    difference so far. Default 0.
+        - maxiter : integer, maximum number of iterations of either solver.
+                    Default None (the fixedpoint solver is unbounded, the
+                    nnls solver uses 3 times the number of isotopologues).
+        - patience: integer, number of consecutive iterations that do not
+                    improve the difference the fixedpoint solver tolerates
+                    before it stops. Default 0, stop at the first one. With
+                    patience the solver returns its best iterate rather than
+                    the last (stalled) one.
+        - acceleration : None (default) or "anderson", extrapolates the
+                    (scaled) subtracted vectors of the fixedpoint solver from
+                    the last ANDERSONDEPTH ones and keeps the extrapolation
+                    whenever it fits the data better than the plain iterate.
+        - trace   : boolean, if True the fixedpoint solver records the L1
+                    difference after every iteration and the CPU time of
+                    every iteration, see the "Trace" result of Run.
     """
     assert(len(order) == len(shape))
+    if(engine not in ENGINES):
+      raise ValueError("Unsupported engine '"+str(engine)+"'")
+    if(solver not in SOLVERS):
+      raise ValueError("Unsupported solver '"+str(solver)+"'")
+    if(acceleration not in ACCELERATIONS):
+      raise ValueError("Unsupported acceleration '"+str(acceleration)+"'")
     self.__dims  = len(shape)
     self.__order = order
     if(slookup is None):
@@ -85,8 +144,38 @@ class NACorrector(object):
     self.__slookup   = slookup
     self.__plookup   = plookup
     self.__results   = None
+    self.__batch     = None
+    self.__engine    = None
+    # The dense NA matrix of the nnls solver is limited to NNLSLIMIT
+    # isotopologues, larger shapes fall back to the fixedpoint solver
+    self.__fallback  = None
+    cells = int(numpy.prod(shape))
+    if(solver == "nnls" and cells > NACorrector.NNLSLIMIT):
+      self.__fallback = ("Too many isotopologues ({0}) for the nnls solver, "
+                         "corrected with the fixedpoint solver".format(cells))
+      solver = "fixedpoint"
+    self.__solver    = solver
+    self.__abstol    = abstol
+    self.__reltol    = reltol
+    self.__maxiter   = maxiter
+    self.__patience  = patience
+    self.__accelerate = acceleration
+    self.__nnlsmatrix = None
+    self.__tracing    = trace
+    self.__trace      = None
+    self.__sparse     = None
     # Initialize critical methods and members based on dimensionality
-    if(self.__dims == 1): 
+    if(self.__dims == 1 and engine == "numpy"):
+      self.__shape     = shape[0]
+      self.__maximums  = shape[0] - 1
+      self.__minimums  = -1 
+      self.__ynacrange = xrange
+      self.__xnacrange = xrange
+      self.__engine    = TriangularNAEngine(plookup, slookup)
+      self.__sum       = numpy.sum
+      self.__sumdiff   = lambda a,b:numpy.abs(numpy.subtract(a,b)).sum()
+      self.__copy      = numpy.array
+    elif(self.__dims == 1): 
       self.__shape     = shape[0]
       self.__maximums  = shape[0] - 1
       self.__minimums  = -1 
@@ -97,10 +186,13 @@ class NACorrector(object):
       self.__copy      = lambda arg:arg[:]
     else:
       self.__shape     = shape
+      if(engine == "numpy"):
+        self.__engine  = KroneckerNAEngine(plookup.Tables, slookup.Tables)
       self.__maximums  = tuple(map(lambda c: c - 1, shape))
       self.__minimums  = self.__dims*(-1,)
       self.__ynacrange = NI.UltimateNACIter
       self.__xnacrange = NI.PenultimateNACIter
+      self.__plan      = NI.GetNACPlan(shape)
       self.__sum       = lambda arg:arg.sum()
       self.__sumdiff   = lambda a,b:(abs(a - b)).sum()
       self.__copy      = lambda arg:arg.copy()
@@ -141,6 +233,46 @@ class NACorrector(object):
       correspond to which axes in this object's Shape property. 
     """
     return self.__order
+
+  @property
+  def Engine(self):
+    """
+    Engine Property
+    ===============
+      Description
+      -----------
+      The vectorized engine used by this object, None if the original
+      element by element loops are used.
+    """
+    return self.__engine
+
+  @property
+  def LookupBytes(self):
+    """
+    LookupBytes Property
+    ====================
+      Description
+      -----------
+      Memory used by the lookup tables of this object in bytes, including
+      the dense lookup arrays built so far.
+    """
+    total = 0
+    for lookup in (self.__slookup, self.__plookup):
+      if(isinstance(lookup, NAnDLookup)): total += lookup.Nbytes
+      else                              : total += numpy.asarray(lookup).nbytes
+    return total
+
+  @property
+  def Solver(self):
+    """
+    Solver Property
+    ===============
+      Description
+      -----------
+      String specifying the solver Run uses, one of SOLVERS. Set by
+      constructor.
+    """
+    return self.__solver
     
   def Run(self, data):
     """
@@ -166,6 +298,10 @@ class NACorrector(object):
           "OriginalData"    : The original input data (ndarray or list)
           "Iterations"      : The number of iterations the correction
                               algorithm ran (integer)
+          "StopReason"      : Why the correction algorithm stopped, one of
+                              "Tolerance", "NoImprovement", "MaxIterations"
+                              (fixedpoint solver) or "Optimal",
+                              "MaxIterations" (nnls solver) (string)
           "CPUTime"         : The CPU Time consumed by this analysis (float)
           "Corrected"       : The corrected values (ndarray or list)
           "TotalNARemoved"  : The total of the data after it was corrected for
@@ -177,28 +313,239 @@ class NACorrector(object):
                               sum of the data after its zero-valued intensites
                               are supplimented with values in "Predicted".
                               (ndarray or list)                              
+          "Residual"        : Only with the "nnls" solver, the euclidean norm
+                              of "Predicted" minus the original data (float)
+          "Fallback"        : Only if the "nnls" solver was asked for but
+                              the shape is too large for it, why the data
+                              was corrected with the fixedpoint solver
+                              (string)
+          "Trace"           : Only if tracing, a dictionary with the L1
+                              differences before the first and after every
+                              iteration ("Diffs") and the CPU time of every
+                              iteration ("IterationTimes"), both lists of
+                              floats, empty with the "nnls" solver
         }
     """
     if(self.__dims == 1) : assert(len(data)  == self.__shape)
     else                 : assert(data.shape == self.__shape)
+    original = data
+    if(self.__engine is not None): data = numpy.asarray(data, dtype=float)
     started = clock()
-    corrected, predicted, iterations = self.RemoveNA(data)
+    self.__trace = None
+    if(self.__solver == "nnls"):
+      corrected, predicted, iterations, residual = self.SolveNNLS(data)
+      reason = self.__nnlsreason(iterations)
+    else:
+      corrected, predicted, iterations, reason = self.RemoveNA(data)
     stopped = clock()
     rfactor = self.__sum(data)/self.__sum(self.ReplaceNegatives(data, predicted))
     renormalized = numpy.multiply(corrected,rfactor)
     self.__results = {}
     # Book keeping
-    self.__results["OriginalData"  ] = data
+    self.__results["OriginalData"  ] = original
     self.__results["Iterations"    ] = iterations
+    self.__results["StopReason"    ] = reason
     self.__results["CPUTime"       ] = stopped - started
     # The good stuff
     self.__results["TotalNARemoved"] = self.__sum(corrected)
     self.__results["Predicted"     ] = predicted
     self.__results["Corrected"     ] = corrected 
     self.__results["Renormalized"  ] = renormalized
+    if(self.__solver == "nnls"):
+      self.__results["Residual"    ] = residual
+    if(self.__tracing):
+      self.__results["Trace"       ] = self.__trace or {"Diffs": [], "IterationTimes": []}
+    if(self.__fallback):
+      self.__results["Fallback"    ] = self.__fallback
     return self.__results
 
-  def FilterFormatResults(self, threshold=float("inf")):
+  def RunSparse(self, peaks):
+    """
+    RunSparse Function
+    ==================
+      Description
+      -----------
+      Sparse version of Run for the peaks of the dictionary "peaks", mapping
+      coordinate tuples to intensities like peakstructures.PeakSet.RawData.
+      Only the isotopologues whose natural abundance can reach an observed
+      (non zero) one are corrected (naengine.SupportCoordinates), with a
+      naengine.SparseNAEngine, so time and memory follow the peaks that were
+      measured rather than the product of the maximums. The isotopologues
+      above the measured ones are left out of the fixed point iteration
+      instead of being filled with their predictions, only the natural
+      abundance they receive is accounted for, so the results agree closely
+      but not exactly with those of Run and they get no corrected intensity.
+      FilterFormatResults computes the predictions of the unobserved
+      isotopologues outside the support on demand, only for the ones that
+      may be above its threshold.
+
+      The dense data is corrected with Run instead when the support cannot
+      be used (engines other than "numpy", the "nnls" solver or no observed
+      peak) or does not pay off (the support is the whole shape or holds
+      more than SPARSELIMIT isotopologues).
+
+      Returns
+      -------
+      The results dictionary of Run. With the support, its arrays hold one
+      value per isotopologue of the support and the extra key "Support" is
+      the list of their coordinate tuples, in the order of
+      naciter.UltimateNACIter.
+    """
+    shape    = (self.__shape,) if(self.__dims == 1) else self.__shape
+    observed = [coordinates for coordinates, value in peaks.iteritems() if(value != 0)]
+    support  = None
+    if(self.__engine is not None and self.__solver == "fixedpoint" and observed):
+      support = SupportCoordinates(observed, shape)
+      if(len(support) == numpy.prod(shape) or len(support) > NACorrector.SPARSELIMIT):
+        support = None
+    if(support is None):
+      if(self.__dims == 1): data = [0]*self.__shape
+      else                : data = numpy.zeros(shape=self.__shape, dtype=float)
+      for coordinates, value in peaks.iteritems():
+        if(self.__dims == 1): data[coordinates[0]] = value
+        else                : data[coordinates]    = value
+      return self.Run(data)
+    tables  = self.__tables()
+    engine  = SparseNAEngine([t[0] for t in tables], [t[1] for t in tables], support)
+    cells   = map(tuple, support.tolist())
+    # The last element is the natural abundance leaving the support
+    data    = numpy.array([peaks.get(c, 0) for c in cells] + [0], dtype=float)
+    started = clock()
+    self.__trace = None
+    corrected, predicted, iterations, reason = self.__fixedpoint(data,
+      engine.AddNA, engine.SubtractNA, engine.ReplaceNegatives, numpy.sum,
+      lambda a,b:numpy.abs(a - b).sum())
+    stopped = clock()
+    rfactor = data.sum()/engine.ReplaceNegatives(data, predicted).sum()
+    self.__sparse  = engine
+    self.__results = {"OriginalData"   : data[:-1],
+                      "Iterations"     : iterations,
+                      "StopReason"     : reason,
+                      "CPUTime"        : stopped - started,
+                      "TotalNARemoved" : corrected.sum(),
+                      "Predicted"      : predicted[:-1],
+                      "Corrected"      : corrected[:-1],
+                      "Renormalized"   : corrected[:-1]*rfactor,
+                      "Support"        : cells}
+    if(self.__tracing):
+      self.__results["Trace"] = self.__trace or {"Diffs": [], "IterationTimes": []}
+    if(self.__fallback):
+      self.__results["Fallback"] = self.__fallback
+    return self.__results
+
+  def Restore(self, results):
+    """
+    Restore Function
+    ================
+      Description
+      -----------
+      Makes "results", the RawResults of a Run or RunSparse call of a
+      corrector with the same order, shape and options (e.g. loaded from a
+      resultstore.ResultStore), the results of the last Run call, so that
+      FilterFormatResults formats them without correcting the data again.
+    """
+    if(results.has_key("Support")):
+      tables = self.__tables()
+      self.__sparse = SparseNAEngine([t[0] for t in tables], [t[1] for t in tables],
+                                     numpy.array(results["Support"], dtype=int))
+    self.__results = results
+
+  def Release(self):
+    """
+    Release Function
+    ================
+      Description
+      -----------
+      Drops the results of the last Run, RunSparse or RunBatch call (and the
+      support engine of RunSparse), e.g. once they have been formatted with
+      FilterFormatResults, so that a corrector kept for reuse does not keep
+      the data of the last set it corrected. RawResults is None afterwards.
+    """
+    self.__results = None
+    self.__batch   = None
+    self.__trace   = None
+    self.__sparse  = None
+
+  def RunBatch(self, data):
+    """
+    RunBatch Function
+    =================
+      Description
+      -----------
+      Runs this natural abundance correction algorithm on every sample in the
+      parameter "data" at once. Every sample is corrected exactly as Run
+      would correct it, including its own number of iterations, but every
+      step is vectorized over the samples that have not converged yet.
+      Requires the "numpy" engine.
+
+      Arguments
+      ---------
+        - data : numpy ndarray
+          A numpy array with shape (samples,) + Shape, one sample of intensity
+          values per row.
+
+      Returns
+      -------
+        A dictionary with the same keys as the one returned by Run, except
+        that every value other than "CPUTime" and "Fallback" is a numpy
+        ndarray with one element (or row) per sample, or a list for "Trace".
+        "CPUTime" is the CPU time consumed by the whole batch. The iteration times of the
+        traces of samples corrected together are the times of the whole
+        iterations.
+    """
+    if(self.__engine is None):
+      raise RuntimeError("RunBatch requires the numpy engine")
+    data  = numpy.asarray(data, dtype=float)
+    shape = (self.__shape,) if(self.__dims == 1) else self.__shape
+    assert(data.ndim == self.__dims + 1 and data.shape[1:] == shape)
+    axes    = tuple(xrange(1, data.ndim))
+    started = clock()
+    if(self.__solver == "nnls"):
+      solved     = map(self.SolveNNLS, data)
+      corrected  = numpy.array([s[0] for s in solved])
+      predicted  = numpy.array([s[1] for s in solved])
+      iterations = numpy.array([s[2] for s in solved])
+      residual   = numpy.array([s[3] for s in solved])
+      reason     = numpy.array(map(self.__nnlsreason, iterations))
+    elif(self.__accelerate is not None):
+      # Extrapolation is done sample by sample
+      solved     = []
+      traces     = []
+      for sample in data:
+        solved.append(self.RemoveNA(sample))
+        traces.append(self.__trace)
+      corrected  = numpy.array([s[0] for s in solved])
+      predicted  = numpy.array([s[1] for s in solved])
+      iterations = numpy.array([s[2] for s in solved])
+      reason     = numpy.array([s[3] for s in solved])
+    else:
+      corrected, predicted, iterations, reason = self.RemoveNABatch(data)
+      traces     = self.__trace
+    stopped = clock()
+    rfactor = data.sum(axis=axes)/self.ReplaceNegatives(data, predicted).sum(axis=axes)
+    renormalized = corrected * rfactor.reshape((-1,) + self.__dims*(1,))
+    self.__batch = {}
+    # Book keeping
+    self.__batch["OriginalData"  ] = data
+    self.__batch["Iterations"    ] = iterations
+    self.__batch["StopReason"    ] = reason
+    self.__batch["CPUTime"       ] = stopped - started
+    # The good stuff
+    self.__batch["TotalNARemoved"] = corrected.sum(axis=axes)
+    self.__batch["Predicted"     ] = predicted
+    self.__batch["Corrected"     ] = corrected
+    self.__batch["Renormalized"  ] = renormalized
+    if(self.__solver == "nnls"):
+      self.__batch["Residual"      ] = residual
+    if(self.__tracing):
+      if(self.__solver == "nnls"):
+        traces = [{"Diffs": [], "IterationTimes": []} for sample in data]
+      self.__batch["Trace"         ] = traces
+    if(self.__fallback):
+      self.__batch["Fallback"      ] = self.__fallback
+    return self.__batch
+
+  def FilterFormatResults(self, threshold=float("inf"), sample=None):
     """
     FilterFormatResults Function
     ============================
@@ -215,6 +562,12 @@ class NACorrector(object):
           A value that the predicted intensity of an unobserved peak must be
           greater than to be included in the results. Default is inf
           (no predictions are included in the results)
+
+      Keyword Arguments
+      -----------------
+        - sample : integer
+          Index of the sample of the last RunBatch call to format. If it is
+          not supplied the results of the last Run call are formatted.
     
       Returns
       -------
@@ -225,14 +578,18 @@ class NACorrector(object):
                                 abundance from the data passed to Run
         "Iterations"          : Iterations required to remove natural 
                                 abundance from the data passed to Run
+        "StopReason"          : Why the algorithm stopped, see Run
         "AccpetedPredictions" : The number of unobserved peaks that whose
                                 predicted values were above threshold which
                                 were included in the results                                
+        "Residual"            : Only with the "nnls" solver, see Run
+        "#Fallback"           : Only with "Fallback" results, see Run
         
         The "#PeakResults" element is special, its value is a dictionary of
         of dictionaries where the first level of keys are tuples specifying
         the peak's coordinate in the data set and the second level are strings
-        defining the result.  It has the following structure:
+        defining the result.  It is a naresults.PeakResults, which also holds
+        the results as arrays.  It has the following structure:
         "#PeakResults"        :                             
         {
           (Peak 0's Coordinates):  
@@ -251,26 +608,57 @@ class NACorrector(object):
         }        
       }
     """
-    assert(self.__results != None)
-    accepted = 0
-    data     = self.__results["OriginalData"]
-    filtered = {"TotalNARemoved"      : self.__results["TotalNARemoved"],
-                "CPUTime"             : self.__results["CPUTime"       ],
-                "Iterations"          : self.__results["Iterations"    ],
-                "AcceptedPredictions" : 0,
-                "#PeakResults"        : {}}
-    for i in self.__ynacrange(self.__shape):
-      observed = (data[i] != 0)
-      if(observed or self.__results["Predicted"][i] > threshold):
-        if(not observed): accepted += 1
-        peakresult = {"Predicted"    : self.__results["Predicted"   ][i],
-                      "Corrected"    : self.__results["Corrected"   ][i],
-                      "Renormalized" : self.__results["Renormalized"][i],
-                      "Unobserved"   : not observed}
-        # Tuplize the index for 1D data to keep interface uniform
-        index = (i,) if(self.__dims == 1) else i 
-        filtered["#PeakResults"][index] = peakresult
-    filtered["AcceptedPredictions"] = accepted
+    if(sample is None):
+      assert(self.__results != None)
+      results = self.__results
+    else:
+      assert(self.__batch != None)
+      results = {}
+      for key, value in self.__batch.iteritems():
+        results[key] = value if(key in ("CPUTime", "Fallback")) else value[sample]
+    data     = results["OriginalData"]
+    filtered = {"TotalNARemoved"      : results["TotalNARemoved"],
+                "CPUTime"             : results["CPUTime"       ],
+                "Iterations"          : results["Iterations"    ],
+                "StopReason"          : results["StopReason"    ],
+                "AcceptedPredictions" : 0}
+    if(results.has_key("Support")):
+      cells       = slice(None)
+      coordinates = numpy.array(results["Support"], dtype=int)
+    elif(self.__dims > 1):
+      # Only the peaks that are observed or predicted above threshold, in
+      # the order of the plan
+      mask        = (numpy.not_equal(data, 0) |
+                     numpy.greater(results["Predicted"], threshold)).ravel()
+      cells       = self.__plan.Flat[mask[self.__plan.Flat]]
+      coordinates = numpy.transpose(numpy.unravel_index(cells, self.__shape))
+    else:
+      cells       = slice(None)
+      coordinates = numpy.arange(self.__shape).reshape((self.__shape, 1))
+    values = [numpy.ravel(numpy.asarray(results[name], dtype=float))[cells]
+              for name in ("OriginalData", "Predicted", "Corrected", "Renormalized")]
+    observed = numpy.not_equal(values[0], 0)
+    peaks    = PeakResults(coordinates, values[1], values[2], values[3], observed,
+                           ~observed & numpy.greater(values[1], threshold))
+    if(results.has_key("Support")):
+      # Predictions outside the support, computed on demand
+      shape      = (self.__shape,) if(self.__dims == 1) else self.__shape
+      candidates = self.__sparse.Candidates(results["Corrected"], threshold, shape)
+      predicted  = self.__sparse.Predict(results["Corrected"], candidates)
+      zeros      = numpy.zeros(len(candidates))
+      outside    = PeakResults(candidates.reshape((len(candidates), len(shape))),
+                               predicted, zeros, zeros, zeros != 0,
+                               numpy.greater(predicted, threshold))
+      # Support and candidates in the order of the plan, as the dense peaks
+      peaks      = PeakResults.Concatenate(peaks, outside).Sorted()
+    filtered["#PeakResults"] = peaks
+    if(results.has_key("Residual")):
+      filtered["Residual"] = results["Residual"]
+    if(results.has_key("Trace")):
+      filtered["#Trace"] = results["Trace"]
+    if(results.has_key("Fallback")):
+      filtered["#Fallback"] = results["Fallback"]
+    filtered["AcceptedPredictions"] = int(numpy.count_nonzero(peaks.Accepted))
     return filtered
     
   def SubtractNA(self, data):
@@ -288,10 +676,18 @@ class NACorrector(object):
           Natural Abudance will be subtracted from.  It must have the same 
           shape as this object
     """
+    if(self.__engine is not None): return self.__engine.SubtractNA(data)
     calc      = self.__copy(data) # Copy Data
     xnacrange = self.__xnacrange  # Iteration function 
     plookup   = self.__plookup    # Binomial Coefficient Product Table
     slookup   = self.__slookup    # Binomial Coefficient Sum Product Table
+    if(self.__dims > 1):
+      for step in self.__plan.Steps:
+        y       = step[0]
+        yvalue  = numpy.subtract.reduce(self.__dominated(calc, step, calc[y]))
+        yvalue /= slookup[y]
+        calc[y] = yvalue if yvalue > 0 else 0 # Improves accuracy
+      return calc
     for y in self.__ynacrange(self.__shape):
       yvalue = calc[y]
       for x in xnacrange(y):
@@ -315,10 +711,17 @@ class NACorrector(object):
           Natural Abudance will be added to.  It must have the same shape
           as this object
     """
+    if(self.__engine is not None): return self.__engine.AddNA(data)
     calc      = self.__copy(data) # Copy data
     xnacrange = self.__xnacrange  # Iteration function
     plookup   = self.__plookup    # Binomial Coefficient Product Table
     slookup   = self.__slookup    # Binomial Coefficient Sum Product Table
+    if(self.__dims > 1):
+      for step in reversed(self.__plan.Steps):
+        y       = step[0]
+        terms   = self.__dominated(calc, step, calc[y] * slookup[y])
+        calc[y] = numpy.add.accumulate(terms)[-1]
+      return calc
     for y in self.__ynacrange(self.__maximums, self.__minimums, -1):
       yvalue = calc[y] * slookup[y]
       for x in xnacrange(y):
@@ -326,6 +729,19 @@ class NACorrector(object):
       calc[y] = yvalue
     return calc
     
+  def __dominated(self, calc, step, first):
+    # "first" followed by calc[x] * plookup[x, y] of every x dominated by y,
+    # in the order of naciter.PenultimateNACIter, for the step (y, box) of
+    # the NACPlan. The products are fetched with one plookup.Slice and
+    # reduced sequentially (subtract.reduce, add.accumulate) so the sums are
+    # those of the element by element loop.
+    y, box   = step
+    products = (calc[box] * self.__plookup.Slice(y)).ravel(order="F")
+    terms    = numpy.empty(len(products))
+    terms[0] = first
+    terms[1:] = products[:-1]
+    return terms
+
   def ReplaceNegatives(self, a, b):
     """
     ReplaceNegatives Function
@@ -343,6 +759,8 @@ class NACorrector(object):
       smaller than or equal to 0 will be replaced by the corresponding element
       in 'b'
     """ 
+    if(self.__engine is not None): return self.__engine.ReplaceNegatives(a, b)
+    if(self.__dims > 1): return numpy.where(numpy.less_equal(a, 0), b, a)
     r = self.__copy(a)
     for coordinates in self.__ynacrange(self.__shape):
       if(a[coordinates] <= 0):
@@ -350,32 +768,245 @@ class NACorrector(object):
     return r
   
   def RemoveNA(self, data):
-    AddNA            = self.AddNA
-    SubtractNA       = self.SubtractNA
-    ReplaceNegatives = self.ReplaceNegatives
-    Sum              = self.__sum
+    """
+    RemoveNA Function
+    =================
+      Description
+      -----------
+      Fixed point solver, alternates SubtractNA and AddNA passes until the L1
+      difference between "data" and the predicted intensities stops
+      improving, improves by less than the tolerances or the maximum number
+      of iterations is reached.
+
+      Returns
+      -------
+      A list with the corrected values, the predicted values, the number of
+      iterations and the reason the solver stopped.
+    """
+    return self.__fixedpoint(data, self.AddNA, self.SubtractNA,
+                             self.ReplaceNegatives, self.__sum, self.__sumdiff)
+
+  def __fixedpoint(self, data, AddNA, SubtractNA, ReplaceNegatives, Sum,
+                   SumDifference):
+    # The RemoveNA iteration with the given NA functions, so RunSparse can
+    # iterate over the support of a SparseNAEngine
     Scale            = numpy.multiply
-    SumDifference    = self.__sumdiff
+    StopReason       = self.__stopreason
+    accelerator      = None
+    if(self.__accelerate == "anderson"):
+      accelerator = AndersonAccelerator(NACorrector.ANDERSONDEPTH)
 
     targetsum  = Sum(data)
     subtracted = SubtractNA(data)
     subsum     = Sum(subtracted)
-    added      = AddNA(Scale(subtracted,targetsum/subsum))
+    scaled     = Scale(subtracted,targetsum/subsum)
+    added      = AddNA(scaled)
     targetsum  = Sum(ReplaceNegatives(data, added))
     addedsum   = Sum(added)
     diff       = SumDifference(data, added)
     lastdiff   = diff * 2  
     iterations = 0
+    stalls     = 0
+    reason     = StopReason(diff, lastdiff, iterations, stalls)
+    # Best iterate, the original loop returned the first stalled one but the
+    # iterates after more stalls may be worse still
+    best       = (subtracted, added, diff)
+    trace      = None
+    if(self.__tracing):
+      trace = {"Diffs": [float(diff)], "IterationTimes": []}
+      tick  = clock()
 
-    while(diff < lastdiff):
-      lastdiff   = diff
+    while(reason is None):
+      lastdiff   = min(diff, lastdiff)
       nextdata   = ReplaceNegatives(data, added)
       nextsum    = Sum(nextdata)
       subtracted = SubtractNA(Scale(nextdata,targetsum/nextsum))
       subsum     = Sum(subtracted)
-      added      = AddNA(Scale(subtracted,targetsum/subsum))
+      nextscaled = Scale(subtracted,targetsum/subsum)
+      added      = AddNA(nextscaled)
+      diff       = SumDifference(data, added)
+      if(accelerator is not None):
+        # Extrapolate the scaled iterates, keep the extrapolation only if it
+        # fits the data better than the plain iterate
+        trial      = numpy.maximum(accelerator.Extrapolate(scaled, nextscaled), 0)
+        trialadded = AddNA(trial)
+        trialdiff  = SumDifference(data, trialadded)
+        if(trialdiff < diff):
+          nextscaled, added, diff = trial, trialadded, trialdiff
+          subtracted = Scale(trial,subsum/targetsum)
+      scaled     = nextscaled
       addedsum   = Sum(added)
       targetsum  = Sum(ReplaceNegatives(data, added))
-      diff       = SumDifference(data, added)
       iterations += 1
-    return [subtracted, added, iterations] 
+      stalls     = 0 if(diff < lastdiff) else stalls + 1
+      reason     = StopReason(diff, lastdiff, iterations, stalls)
+      if(diff < best[2]): best = (subtracted, added, diff)
+      if(trace is not None):
+        trace["Diffs"].append(float(diff))
+        trace["IterationTimes"].append(clock() - tick)
+        tick = clock()
+    if(self.__patience > 0 and reason != "Tolerance"):
+      subtracted, added = best[0], best[1]
+    self.__trace = trace
+    return [subtracted, added, iterations, reason]
+
+  def SolveNNLS(self, data):
+    """
+    SolveNNLS Function
+    ==================
+      Description
+      -----------
+      Removes natural abundance from "data" by solving the non-negative least
+      squares problem min ||M.x - data|| with x >= 0, where M.x adds natural
+      abundance to x (see AddNA). Zero intensities are fitted as zeros. The
+      dense NA matrix is built on the first call and reused afterwards, so it
+      is limited to NNLSLIMIT isotopologues.
+
+      Returns
+      -------
+      A list with the corrected values, the predicted values (M.x), the
+      number of solver iterations and the euclidean norm of the residual.
+    """
+    if(self.__nnlsmatrix is None):
+      self.__nnlsmatrix = self.__densematrix()
+    shape = numpy.shape(data)
+    solution, residual, iterations = NNLS(self.__nnlsmatrix, numpy.ravel(data), self.__maxiter)
+    corrected = solution.reshape(shape)
+    predicted = numpy.dot(self.__nnlsmatrix, solution).reshape(shape)
+    return [corrected, predicted, iterations, residual]
+
+  def __nnlsreason(self, iterations):
+    maxiter = self.__maxiter
+    if(maxiter is None): maxiter = 3*len(self.__nnlsmatrix)
+    return "MaxIterations" if(iterations >= maxiter) else "Optimal"
+
+  def __stopreason(self, diff, best, iterations, stalls):
+    # Why the fixedpoint solver should stop, None if it should continue
+    # A difference that is not a number (a set without intensity) never
+    # improves, stop right away like the original loop did
+    if(numpy.isnan(diff)):
+      return "NoImprovement"
+    if(iterations > 0 and diff < best and
+       best - diff <= max(self.__abstol, self.__reltol*best)):
+      return "Tolerance"
+    if(diff == 0):
+      return "Tolerance"
+    if(diff >= best and stalls > self.__patience):
+      return "NoImprovement"
+    if(self.__maxiter is not None and iterations >= self.__maxiter):
+      return "MaxIterations"
+    return None
+
+  def __densematrix(self):
+    # Dense NA matrix (transposed so that it multiplies column vectors) of
+    # the data flattened in C order
+    tables = self.__tables()
+    cells = numpy.prod(map(len, map(lambda t: t[1], tables)))
+    if(cells > NACorrector.NNLSLIMIT):
+      raise RuntimeError("Too many isotopologues ({0}) for the nnls solver".format(cells))
+    matrix = numpy.ones((1, 1))
+    for ptable, stable in tables:
+      matrix = numpy.kron(matrix, NAMatrix(ptable, stable))
+    return matrix.T
+
+  def __tables(self):
+    # (product table, sum product table) of every label
+    if(self.__dims == 1):
+      return [(self.__plookup, self.__slookup)]
+    return zip(self.__plookup.Tables, self.__slookup.Tables)
+
+  def RemoveNABatch(self, data):
+    """
+    RemoveNABatch Function
+    ======================
+      Description
+      -----------
+      Vectorized RemoveNA over the samples (rows) of "data". Samples stop
+      iterating independently, exactly when RemoveNA would stop for them.
+      Acceleration is not supported.
+
+      Returns
+      -------
+      A list with the corrected values, the predicted values, the number
+      of iterations and the reasons the solver stopped of every sample, all
+      numpy ndarrays with one element (or row) per sample.
+    """
+    AddNA            = self.AddNA
+    SubtractNA       = self.SubtractNA
+    ReplaceNegatives = self.ReplaceNegatives
+    StopReasons      = self.__stopreasons
+    axes             = tuple(xrange(1, numpy.ndim(data)))
+    Sum              = lambda arg:arg.sum(axis=axes)
+    Scale            = lambda arg,factor:arg*factor.reshape((-1,) + len(axes)*(1,))
+    SumDifference    = lambda a,b:(abs(a - b)).sum(axis=axes)
+
+    targetsum  = Sum(data)
+    subtracted = SubtractNA(data)
+    subsum     = Sum(subtracted)
+    added      = AddNA(Scale(subtracted,targetsum/subsum))
+    targetsum  = Sum(ReplaceNegatives(data, added))
+    diff       = SumDifference(data, added)
+    lastdiff   = diff * 2
+    iterations = numpy.zeros(len(data), dtype=int)
+    stalls     = numpy.zeros(len(data), dtype=int)
+    reason     = StopReasons(diff, lastdiff, iterations, stalls)
+    active     = numpy.flatnonzero(numpy.equal(reason, None))
+    # Best iterates, only needed when stalled iterates are not returned
+    patient    = self.__patience > 0
+    if(patient):
+      bestsub  = subtracted.copy()
+      bestadd  = added.copy()
+      bestdiff = diff.copy()
+    traces     = None
+    if(self.__tracing):
+      traces = [{"Diffs": [float(d)], "IterationTimes": []} for d in diff]
+      tick   = clock()
+
+    while(len(active) != 0):
+      lastdiff[active] = numpy.minimum(diff[active], lastdiff[active])
+      sampled    = data[active]
+      nextdata   = ReplaceNegatives(sampled, added[active])
+      nextsum    = Sum(nextdata)
+      subsampled = SubtractNA(Scale(nextdata,targetsum[active]/nextsum))
+      subsum     = Sum(subsampled)
+      addsampled = AddNA(Scale(subsampled,targetsum[active]/subsum))
+      targetsum[active]  = Sum(ReplaceNegatives(sampled, addsampled))
+      diff[active]       = SumDifference(sampled, addsampled)
+      subtracted[active] = subsampled
+      added[active]      = addsampled
+      iterations[active] += 1
+      improved           = diff[active] < lastdiff[active]
+      stalls[active]     = numpy.where(improved, 0, stalls[active] + 1)
+      reason[active]     = StopReasons(diff[active], lastdiff[active],
+                                       iterations[active], stalls[active])
+      if(patient):
+        better = active[diff[active] < bestdiff[active]]
+        bestsub[better]  = subtracted[better]
+        bestadd[better]  = added[better]
+        bestdiff[better] = diff[better]
+      if(traces is not None):
+        elapsed = clock() - tick
+        for sample in active:
+          traces[sample]["Diffs"].append(float(diff[sample]))
+          traces[sample]["IterationTimes"].append(elapsed)
+        tick = clock()
+      active = active[numpy.equal(reason[active], None)]
+    if(patient):
+      stalled = numpy.flatnonzero(reason != "Tolerance")
+      subtracted[stalled] = bestsub[stalled]
+      added[stalled]      = bestadd[stalled]
+    self.__trace = traces
+    return [subtracted, added, iterations, reason]
+
+  def __stopreasons(self, diff, best, iterations, stalls):
+    # Vectorized __stopreason, higher priority reasons are assigned last
+    reasons  = numpy.empty(len(diff), dtype=object)
+    improved = diff < best
+    if(self.__maxiter is not None):
+      reasons[iterations >= self.__maxiter] = "MaxIterations"
+    reasons[~improved & (stalls > self.__patience)] = "NoImprovement"
+    reasons[numpy.isnan(diff)] = "NoImprovement"
+    tolerance = numpy.maximum(self.__abstol, self.__reltol*best)
+    reasons[(iterations > 0) & improved & (best - diff <= tolerance)] = "Tolerance"
+    reasons[diff == 0] = "Tolerance"
+    return reasons
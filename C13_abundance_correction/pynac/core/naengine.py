@@ -0,0 +1,412 @@
+#!/usr/bin/python
+# Standard Packages
+import numpy
+
+def NAMatrix(ptable, stable):
+  """
+  NAMatrix Function
+  =================
+    Description
+    -----------
+    Builds the upper-triangular natural abundance matrix M for one labeling
+    isotope from the tables generated by nalookup.NABCTables. M[x,y] is the
+    fraction of the isotopologue x that is observed as y (x < y) and M[y,y]
+    is the fraction of y that stays at y, so adding natural abundance to a
+    vector v is v.M and removing it is a triangular solve against M.
+
+    Arguments
+    ---------
+      - ptable : numpy.ndarray, binomial coefficient product table
+      - stable : list of floats, binomial coefficient sum product table
+  """
+  matrix = numpy.triu(numpy.array(ptable, dtype=float), 1)
+  matrix[numpy.diag_indices_from(matrix)] = stable
+  return matrix
+
+def ApplyAxis(matrix, data, axis):
+  """
+  ApplyAxis Function
+  ==================
+    Description
+    -----------
+    Multiplies the axis "axis" of the numpy.ndarray "data" by "matrix", ie
+    result[..., y, ...] = sum over x of data[..., x, ...] * matrix[x, y]
+  """
+  product = numpy.tensordot(data, matrix, axes=([axis], [0]))
+  return numpy.moveaxis(product, -1, axis)
+
+class TriangularNAEngine(object):
+  """
+  TriangularNAEngine Object
+  =========================
+    Description
+    -----------
+    Vectorized replacement for the single-label SubtractNA, AddNA and
+    ReplaceNegatives loops of nacmath.NACorrector. Addition is a single
+    vector-matrix product with the NA matrix. Subtraction is a single product
+    with the precomputed inverse of the NA matrix; whenever a corrected value
+    would become negative it is clamped to zero (like the loop version does)
+    and the effect of the clamp is propagated to the following isotopologues
+    with one row of the inverse. Any upper-triangular NA matrix can be given
+    as "matrix" instead of the tables.
+  """
+  def __init__(self, ptable=None, stable=None, matrix=None):
+    if(matrix is None): matrix = NAMatrix(ptable, stable)
+    self.__matrix   = matrix
+    self.__inverse  = numpy.triu(numpy.linalg.inv(self.__matrix))
+    self.__diagonal = self.__matrix.diagonal().copy()
+
+  @property
+  def Matrix(self):
+    return self.__matrix
+
+  @property
+  def Inverse(self):
+    return self.__inverse
+
+  def SubtractNA(self, data):
+    data = numpy.asarray(data, dtype=float)
+    # Non finite values are clamped to zero one isotopologue at a time, like
+    # the loop version, instead of spreading through the inverse
+    if(numpy.ndim(data) > 1 or not numpy.isfinite(data).all()):
+      return self.__sweep(data)
+    calc     = numpy.dot(data, self.__inverse)
+    inverse  = self.__inverse
+    diagonal = self.__diagonal
+    start    = 0
+    while(True):
+      negatives = numpy.flatnonzero(calc[start:] < 0)
+      if(len(negatives) == 0): break
+      y = start + negatives[0]
+      calc[y:] -= (calc[y] * diagonal[y]) * inverse[y, y:]
+      calc[y]   = 0.0
+      start     = y + 1
+    return calc
+
+  def AddNA(self, data):
+    return numpy.dot(numpy.asarray(data, dtype=float), self.__matrix)
+
+  def ReplaceNegatives(self, a, b):
+    a = numpy.asarray(a, dtype=float)
+    with numpy.errstate(invalid="ignore"):
+      return numpy.where(a <= 0, b, a)
+
+  def __sweep(self, data):
+    # Batches of samples (one per row) are corrected one isotopologue at a
+    # time, every step being vectorized over the samples
+    matrix = self.__matrix
+    calc   = numpy.array(data, dtype=float)
+    with numpy.errstate(invalid="ignore"):
+      for y in xrange(calc.shape[-1]):
+        value = (calc[..., y] - numpy.dot(calc[..., :y], matrix[:y, y])) / matrix[y, y]
+        # Clamps NaN as well, like "yvalue if yvalue > 0 else 0"
+        calc[..., y] = numpy.where(value > 0, value, 0)
+    return calc
+
+class KroneckerNAEngine(object):
+  """
+  KroneckerNAEngine Object
+  ========================
+    Description
+    -----------
+    Vectorized replacement for the multi-label SubtractNA, AddNA and
+    ReplaceNegatives loops of nacmath.NACorrector. The multi-label NA matrix
+    is the tensor (Kronecker) product of the single-label NA matrices, and so
+    is its inverse, so natural abundance is added or removed by multiplying
+    each axis of the data by its own matrix. The pairwise isotopologue space
+    is never built.
+
+    When removing natural abundance produces no negative values the result is
+    the product with the inverse matrices. Otherwise the values are computed
+    in the same order as the loop version (naciter.UltimateNACIter) and
+    negatives are clamped to zero, but only the isotopologues that end up
+    with a positive value cost any work: each one subtracts its contribution
+    from the isotopologues that dominate it with one outer product of the
+    single-label matrices. Contributions only ever decrease the values still
+    to be computed, so the isotopologues that can become positive are known
+    up front and are screened in blocks of SCREENSIZE.
+
+    Data with more dimensions than the engine is treated as a batch of
+    samples stacked along the leading axes.
+  """
+  SCREENSIZE = 256
+  def __init__(self, ptables, stables):
+    assert(len(ptables) == len(stables))
+    self.__dims     = len(ptables)
+    self.__engines  = []
+    for axis in xrange(self.__dims):
+      self.__engines.append(TriangularNAEngine(ptables[axis], stables[axis]))
+    self.__matrices = [engine.Matrix  for engine in self.__engines]
+    self.__inverses = [engine.Inverse for engine in self.__engines]
+    # Matrices with their columns divided by the diagonal
+    self.__scaled   = [m / m.diagonal() for m in self.__matrices]
+    diagonal = numpy.ones(())
+    for matrix in self.__matrices:
+      diagonal = numpy.multiply.outer(diagonal, matrix.diagonal())
+    self.__diagonal = diagonal
+
+  @property
+  def Engines(self):
+    return self.__engines
+
+  def SubtractNA(self, data):
+    calc = self.__apply(self.__inverses, data)
+    if((calc >= 0).all()): return calc
+    if(calc.ndim == self.__dims): return self.__substitute(data)
+    # Batch, only the samples with negatives need to be substituted
+    shape = calc.shape
+    data  = numpy.asarray(data, dtype=float).reshape((-1,) + shape[-self.__dims:])
+    calc  = calc.reshape(data.shape)
+    for sample in numpy.flatnonzero((calc < 0).reshape(len(calc), -1).any(axis=1)):
+      calc[sample] = self.__substitute(data[sample])
+    return calc.reshape(shape)
+
+  def AddNA(self, data):
+    return self.__apply(self.__matrices, data)
+
+  def ReplaceNegatives(self, a, b):
+    a = numpy.asarray(a, dtype=float)
+    return numpy.where(a <= 0, b, a)
+
+  def __substitute(self, data):
+    # Forward substitution of a single sample, skipping zeros
+    shape  = numpy.shape(data)
+    scaled = self.__scaled
+    remain = numpy.asfortranarray(numpy.divide(data, self.__diagonal))
+    calc   = numpy.zeros(shape, dtype=float, order="F")
+    flat   = remain.ravel(order="F")
+    screen = numpy.flatnonzero(flat > 0)
+    start  = 0
+    while(start < len(screen)):
+      block = screen[start:start + KroneckerNAEngine.SCREENSIZE]
+      hits  = numpy.flatnonzero(flat[block] > 0)
+      if(len(hits) == 0):
+        start += len(block)
+        continue
+      start += hits[0] + 1
+      index  = block[hits[0]]
+      y      = numpy.unravel_index(index, shape, order="F")
+      value  = flat[index]
+      calc[y] = value
+      update = value * scaled[0][y[0], y[0]:]
+      for axis in xrange(1, self.__dims):
+        update = numpy.multiply.outer(update, scaled[axis][y[axis], y[axis]:])
+      remain[tuple(map(lambda c: slice(c, None), y))] -= update
+    return calc
+
+  def __apply(self, matrices, data):
+    data   = numpy.asarray(data, dtype=float)
+    offset = data.ndim - self.__dims
+    for axis in xrange(self.__dims):
+      data = ApplyAxis(matrices[axis], data, offset + axis)
+    return data
+
+def SupportCoordinates(coordinates, shape):
+  """
+  SupportCoordinates Function
+  ===========================
+    Description
+    -----------
+    The isotopologues x <= y (on every axis) of every coordinate tuple y in
+    "coordinates", ie every isotopologue whose natural abundance can reach
+    an observed one, as a numpy integer array with one row per isotopologue
+    in the order of naciter.UltimateNACIter (first axis fastest).
+  """
+  coordinates = numpy.array(list(coordinates), dtype=int).reshape((-1, len(shape)))
+  # Only the coordinates no other one dominates add isotopologues
+  tops = []
+  for y in coordinates[numpy.lexsort(coordinates.T)[::-1]]:
+    if(not any([(y <= top).all() for top in tops])): tops.append(y)
+  flat = [numpy.ravel_multi_index(numpy.indices(top + 1).reshape(len(shape), -1),
+                                  shape, order="F") for top in tops]
+  flat = numpy.unique(numpy.concatenate(flat)) if(flat) else numpy.zeros(0, dtype=int)
+  return numpy.array(numpy.unravel_index(flat, shape, order="F"), dtype=int).T
+
+class SparseNAEngine(TriangularNAEngine):
+  """
+  SparseNAEngine Object
+  =====================
+    Description
+    -----------
+    TriangularNAEngine over the isotopologues of "support" (as returned by
+    SupportCoordinates) only, instead of the whole product space of the
+    labels. Its NA matrix holds the products of the table entries of every
+    pair of isotopologues of the support, so memory and time follow the
+    size of the support. The isotopologues outside the support get no
+    intensity of their own; Predict computes the natural abundance the
+    support adds to any of them and Candidates finds the ones that may be
+    predicted above a threshold.
+
+    The vectors of SubtractNA, AddNA and ReplaceNegatives have one element
+    per isotopologue of the support followed by the natural abundance that
+    leaves the support, which AddNA sets and SubtractNA zeroes, so the sums
+    and differences of the fixed point iteration account for it like they
+    do with the whole product space.
+  """
+  # Number of isotopologues predicted at once by Predict
+  BLOCKSIZE = 1024
+  def __init__(self, ptables, stables, support):
+    self.__ptables = [numpy.asarray(ptable, dtype=float) for ptable in ptables]
+    self.__support = numpy.asarray(support, dtype=int)
+    matrix = self.__products(self.__support)
+    diagonal = numpy.ones(len(self.__support))
+    for axis in xrange(len(stables)):
+      diagonal *= numpy.asarray(stables[axis], dtype=float)[self.__support[:, axis]]
+    matrix[numpy.diag_indices_from(matrix)] = diagonal
+    # Fraction of every isotopologue of the support that leaves it, the rows
+    # of the whole NA matrix sum to one
+    self.__leaving = 1 - matrix.sum(axis=1)
+    TriangularNAEngine.__init__(self, matrix=matrix)
+
+  @property
+  def Support(self):
+    return self.__support
+
+  def SubtractNA(self, data):
+    data = numpy.asarray(data, dtype=float)
+    return numpy.append(TriangularNAEngine.SubtractNA(self, data[:-1]), 0.0)
+
+  def AddNA(self, data):
+    data = numpy.asarray(data, dtype=float)[:-1]
+    return numpy.append(TriangularNAEngine.AddNA(self, data),
+                        numpy.dot(data, self.__leaving))
+
+  def Predict(self, values, cells):
+    # Natural abundance added by "values" (one per isotopologue of the
+    # support) to the isotopologues of "cells", none of them in the support
+    values    = numpy.asarray(values, dtype=float)
+    cells     = numpy.asarray(cells, dtype=int).reshape((-1, self.__support.shape[1]))
+    predicted = numpy.zeros(len(cells))
+    for start in xrange(0, len(cells), SparseNAEngine.BLOCKSIZE):
+      block = cells[start:start + SparseNAEngine.BLOCKSIZE]
+      predicted[start:start + len(block)] = numpy.dot(values, self.__products(block))
+    return predicted
+
+  def Candidates(self, values, threshold, shape):
+    """
+    Candidates Function
+    ===================
+      Description
+      -----------
+      The isotopologues outside the support whose predicted intensity may
+      be above "threshold", in the order of naciter.UltimateNACIter. The
+      prediction of y is bounded by the sum of "values" times the product
+      over the axes of the largest table entry leading to y[axis] from the
+      support, only the isotopologues with a bound above threshold are
+      enumerated.
+    """
+    total = numpy.abs(values).sum()
+    dims  = len(shape)
+    if(total == 0 or not threshold < numpy.inf):
+      return numpy.zeros((0, dims), dtype=int)
+    bounds = []
+    for axis in xrange(dims):
+      rows = numpy.unique(self.__support[:, axis])
+      bounds.append(self.__ptables[axis][rows].max(axis=0))
+    # Largest bound the axes after every axis can still contribute
+    rest = numpy.ones(dims + 1)
+    for axis in xrange(dims - 1, -1, -1):
+      rest[axis] = rest[axis + 1]*bounds[axis].max()
+    limit   = threshold/total
+    partial = numpy.ones(1)
+    cells   = numpy.zeros((1, 0), dtype=int)
+    for axis in xrange(dims):
+      partial = numpy.multiply.outer(partial, bounds[axis]).ravel()
+      cells   = numpy.hstack([numpy.repeat(cells, len(bounds[axis]), axis=0),
+                              numpy.tile(numpy.arange(len(bounds[axis])), len(cells))[:, numpy.newaxis]])
+      keep    = partial*rest[axis + 1] > limit
+      partial = partial[keep]
+      cells   = cells[keep]
+    flat    = numpy.ravel_multi_index(cells.T, shape, order="F")
+    inside  = numpy.ravel_multi_index(self.__support.T, shape, order="F")
+    outside = numpy.sort(flat[~numpy.in1d(flat, inside)])
+    return numpy.array(numpy.unravel_index(outside, shape, order="F"), dtype=int).reshape((dims, -1)).T
+
+  def __products(self, cells):
+    # Products over the axes of the table entries from every isotopologue of
+    # the support (rows) to every isotopologue of "cells" (columns)
+    support = self.__support
+    matrix  = numpy.ones((len(support), len(cells)))
+    for axis in xrange(len(self.__ptables)):
+      matrix *= self.__ptables[axis][numpy.ix_(support[:, axis], cells[:, axis])]
+    return matrix
+
+def NNLS(matrix, vector, maxiter=None):
+  """
+  NNLS Function
+  =============
+    Description
+    -----------
+    Solves min ||matrix.x - vector|| subject to x >= 0 with the active set
+    algorithm of Lawson and Hanson. The algorithm is deterministic and stops
+    after at most "maxiter" iterations (default 3 times the number of
+    columns of "matrix").
+
+    Returns
+    -------
+    A list with the solution x, the euclidean norm of the residual and the
+    number of iterations used.
+  """
+  matrix  = numpy.asarray(matrix, dtype=float)
+  vector  = numpy.asarray(vector, dtype=float)
+  columns = matrix.shape[1]
+  if(maxiter is None): maxiter = 3*columns
+  tolerance  = 10*numpy.finfo(float).eps*numpy.abs(matrix).sum(axis=0).max()*max(matrix.shape)
+  tolerance *= max(1.0, numpy.abs(vector).max())
+  solution   = numpy.zeros(columns)
+  passive    = numpy.zeros(columns, dtype=bool)
+  gradient   = numpy.dot(matrix.T, vector)
+  iterations = 0
+  while(iterations < maxiter and not passive.all() and
+        gradient[~passive].max() > tolerance):
+    passive[numpy.argmax(numpy.where(passive, -numpy.inf, gradient))] = True
+    while(iterations < maxiter):
+      iterations += 1
+      trial = numpy.zeros(columns)
+      if(passive.any()):
+        trial[passive] = numpy.linalg.lstsq(matrix[:, passive], vector, rcond=None)[0]
+      if(not passive.any() or trial[passive].min() > 0):
+        solution = trial
+        break
+      # Step back towards the last feasible solution and drop the variables
+      # that hit zero from the passive set
+      blocking  = passive & (trial <= 0)
+      step      = solution[blocking]/(solution[blocking] - trial[blocking])
+      solution += step.min()*(trial - solution)
+      passive  &= solution > tolerance
+      solution[~passive] = 0
+    gradient = numpy.dot(matrix.T, vector - numpy.dot(matrix, solution))
+  residual = numpy.linalg.norm(numpy.dot(matrix, solution) - vector)
+  return [solution, residual, iterations]
+
+class AndersonAccelerator(object):
+  """
+  AndersonAccelerator Object
+  ==========================
+    Description
+    -----------
+    Anderson extrapolation of a fixed point iteration x = G(x). Every call
+    to Extrapolate records an input x and its image G(x) and returns the
+    combination of the last "depth" + 1 images whose residuals G(x) - x
+    combine to the smallest residual in the least squares sense.
+  """
+  def __init__(self, depth=3):
+    self.__depth  = depth
+    self.__inputs = []
+    self.__images = []
+
+  def Extrapolate(self, x, image):
+    shape = numpy.shape(image)
+    self.__inputs.append(numpy.ravel(x).astype(float))
+    self.__images.append(numpy.ravel(image).astype(float))
+    if(len(self.__images) > self.__depth + 1):
+      self.__inputs.pop(0)
+      self.__images.pop(0)
+    if(len(self.__images) < 2):
+      return numpy.reshape(self.__images[-1], shape)
+    images    = numpy.array(self.__images).T
+    residuals = images - numpy.array(self.__inputs).T
+    dresidual = numpy.diff(residuals, axis=1)
+    dimage    = numpy.diff(images, axis=1)
+    gamma     = numpy.linalg.lstsq(dresidual, residuals[:, -1], rcond=None)[0]
+    return numpy.reshape(images[:, -1] - numpy.dot(dimage, gamma), shape)
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# Standard Packages
+from collections import Mapping
+import numpy
+
+class PeakResults(Mapping):
+  """
+  PeakResults Object
+  ==================
+    Description
+    -----------
+    The "#PeakResults" of NACorrector.FilterFormatResults as arrays. Every
+    cell the thresholding looked at is a row of Coordinates, with its
+    Predicted, Corrected and Renormalized intensities, whether it was
+    observed (Observed) and whether its prediction was accepted (Accepted,
+    unobserved and predicted above the threshold). The peak results are
+    the observed or accepted cells (Entries), in the order of
+    naciter.UltimateNACIter (first axis fastest) in which NACorrector
+    inserts them.
+
+    It is also the read only dictionary of earlier versions, from
+    coordinate tuples to dictionaries with the "Predicted", "Corrected",
+    "Renormalized" and "Unobserved" results of a peak, only built when it
+    is first used as one.
+
+    Arguments
+    ---------
+      - coordinates  : array of the coordinates of the cells, one row each
+      - predicted    : array of the predicted intensities of the cells
+      - corrected    : array of the corrected intensities of the cells
+      - renormalized : array of the renormalized intensities of the cells
+      - observed     : boolean array, True for the observed cells
+      - accepted     : boolean array, True for the accepted predictions
+
+    Example
+    -------
+    >>> peaks = corrector.FilterFormatResults(threshold)["#PeakResults"]
+    >>> peaks.Corrected[peaks.Entries]
+    >>> peaks[(0, 1)]["Corrected"]
+  """
+  FIELDS = ("Predicted", "Corrected", "Renormalized", "Unobserved")
+  ARRAYS = ("Coordinates", "Predicted", "Corrected", "Renormalized", "Observed",
+            "Accepted")
+  def __init__(self, coordinates, predicted, corrected, renormalized,
+               observed, accepted):
+    self.Coordinates  = coordinates
+    self.Predicted    = predicted
+    self.Corrected    = corrected
+    self.Renormalized = renormalized
+    self.Observed     = observed
+    self.Accepted     = accepted
+    self.Entries      = numpy.flatnonzero(observed | accepted)
+    self.__view       = None
+
+  @staticmethod
+  def Concatenate(first, second):
+    # Cells of "first" followed by the cells of "second"
+    return PeakResults(*[numpy.concatenate((getattr(first, name), getattr(second, name)))
+                         for name in PeakResults.ARRAYS])
+
+  def Sorted(self):
+    # The cells in the order of naciter.UltimateNACIter, last axis slowest
+    order = numpy.lexsort(self.Coordinates.T)
+    return PeakResults(*[getattr(self, name)[order] for name in PeakResults.ARRAYS])
+
+  def Keys(self):
+    # Coordinate tuples of the entries, in insertion order
+    return [tuple(index) for index in self.Coordinates[self.Entries].tolist()]
+
+  def Values(self, field, cells):
+    # Results "field" of the cells "cells"
+    if(field == "Unobserved"): return (~self.Observed[cells]).tolist()
+    return getattr(self, field)[cells]
+
+  def __dictionary(self):
+    if(self.__view is None):
+      self.__view = {}
+      for key, entry in zip(self.Keys(), self.Entries):
+        self.__view[key] = {"Predicted"    : self.Predicted   [entry],
+                            "Corrected"    : self.Corrected   [entry],
+                            "Renormalized" : self.Renormalized[entry],
+                            "Unobserved"   : not self.Observed[entry]}
+    return self.__view
+
+  def __getstate__(self):
+    # The dictionary is built again from the arrays
+    state = self.__dict__.copy()
+    state["_PeakResults__view"] = None
+    return state
+
+  def __getitem__(self, key):
+    return self.__dictionary()[key]
+
+  def __iter__(self):
+    return iter(self.__dictionary())
+
+  def __len__(self):
+    return len(self.Entries)
+
+  def __contains__(self, key):
+    return key in self.__dictionary()
+
+  def has_key(self, key):
+    return key in self.__dictionary()
+
+  def __repr__(self):
+    return repr(self.__dictionary())
@@ -5,9 +5,14 @@ __author__ = 'Zhengtao Xiao'
 # the column named "Name" will be used for grouping molecules
 # all the columns at right side of "MZ" columns will be calculated
 # change 1: naming rule has been changed to: [13C]1TG(12:0/16:0/18:0)
+# change 2: can run without prompts, see: python calculate_percent.py -h
 ################################################
-from openpyxl import load_workbook
+from openpyxl import load_workbook,Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Border,Side
+from openpyxl.utils import get_column_letter
+import argparse
+import numpy
 import sys
 import re
 import os
@@ -17,9 +22,9 @@ pattern = re.compile(r'^\[13C\]\d+') # for [13C]1TG(12:0/16:0/18:0)
 #pattern = re.compile(r'^\d+\[13C\]') # for 1[13C]TG(12:0/16:0/18:0)
 c13_abundance_percet = 0.1
 #####################
-def border_range(sheet,row_range,col_range,color="0000FF"):
+def border_styles(color="0000FF"):
 	"""
-	apply styles to a range of cells
+	the borders around a range of cells, by position in the range
 	"""
 	top = Border(top=Side(border_style="thin",color=color))
 	right = Border(right=Side(border_style="thin",color=color))
@@ -32,102 +37,232 @@ def border_range(sheet,row_range,col_range,color="0000FF"):
 	bot_left = Border(bottom=Side(border_style="thin",color=color),
 				left=Side(border_style="thin",color=color))
 	bot_right = Border(bottom=Side(border_style="thin",color=color),
-				right=Side(border_style="thin",color=color))		
+				right=Side(border_style="thin",color=color))
+	return {"top":top,"right":right,"left":left,"bottom":bottom,
+		"top_left":top_left,"top_right":top_right,
+		"bot_left":bot_left,"bot_right":bot_right}
+
+def border_at(styles,r,c,row_range,col_range):
+	"""
+	the border of cell (r,c) when the range of cells gets a border,
+	None inside the range
+	"""
+	border = None
 	#first line cell
-	for c in col_range:
-		sheet.cell(row=row_range[0],column=c).border = top
+	if r == row_range[0]:
+		border = styles["top"]
 	#last line
-	for c in col_range:
-		sheet.cell(row=row_range[-1],column=c).border = bottom
+	if r == row_range[-1]:
+		border = styles["bottom"]
 	#left
-	for r in row_range:
-		sheet.cell(row=r,column=col_range[0]).border = left
+	if c == col_range[0]:
+		border = styles["left"]
 		if r == row_range[0]:
-			sheet.cell(row=r,column=col_range[0]).border = top_left
+			border = styles["top_left"]
 		if r == row_range[-1]:
-			sheet.cell(row=r,column=col_range[0]).border = bot_left
-
-	#right 
-	for r in row_range:
-		sheet.cell(row=r,column=col_range[-1]).border = right
+			border = styles["bot_left"]
+	#right
+	if c == col_range[-1]:
+		border = styles["right"]
 		if r == row_range[0]:
-			sheet.cell(row=r,column=col_range[-1]).border = top_right
+			border = styles["top_right"]
 		if r == row_range[-1]:
-			sheet.cell(row=r,column=col_range[-1]).border = bot_right
+			border = styles["bot_right"]
+	return border
+
+def read_sheet(filename):
+	"""
+	read the active sheet in read only mode, no cell objects or styles are
+	kept. returns the sheet title and the cell values as a numpy object
+	array, one row per sheet row, None for empty cells
+	"""
+	inWb = load_workbook(filename,read_only=True)
+	sheet = inWb.active
+	title = sheet.title
+	rows = [[cell.value for cell in row] for row in sheet.rows]
+	inWb.close()
+	ncol = max([len(row) for row in rows] + [0])
+	values = numpy.empty((len(rows),ncol),dtype=object)
+	for row_i,row in enumerate(rows):
+		values[row_i,:len(row)] = row
+	return title,values
+
+def find_groups(names,pattern):
+	"""
+	the (first row, last row) of every group of molecules, a group begins
+	at every name that does not match the pattern
+	"""
+	groups = []
+	max_nrow = len(names)
+	sum_begin_row = 2
+	for row_idx,value in enumerate(names,1):
+		if not str(value):
+			print "Error: please delete the blank rows"
+			sys.exit(1)
+		name = str(value).strip()
+		if (row_idx > 2 and not re.match(pattern,name)) or row_idx == max_nrow:
+			if row_idx == max_nrow :
+				sum_end_row=row_idx
+			else:
+				sum_end_row = row_idx -1
+			groups.append((sum_begin_row,sum_end_row))
+			sum_begin_row = row_idx
+	return groups
+
+def to_number(value):
+	#empty cells count as 0 and text is left out, as in excel
+	if value is None:
+		return 0.0
+	if isinstance(value,(int,long,float)) and not isinstance(value,bool):
+		return float(value)
+	return numpy.nan
 
+def percentages(data,groups):
+	"""
+	the percentage of every value in its group, computed with grouped sums.
+	data holds the values of sheet rows 2 and below, rows out of any group
+	and values that cannot be computed (text or a zero sum) are nan
+	"""
+	numbers = numpy.frompyfunc(to_number,1,1)(data).astype(float)
+	percent = numpy.empty(numbers.shape)
+	percent.fill(numpy.nan)
+	groups = [(b,e) for b,e in groups if e >= b]
+	if not groups or numbers.size == 0:
+		return percent
+	begins = numpy.array([b for b,e in groups]) - 2
+	ends = numpy.array([e for b,e in groups]) - 1
+	#sheet rows of the groups are contiguous, from the first begin to the last end
+	covered = slice(begins[0],ends[-1])
+	sums = numpy.add.reduceat(numpy.nan_to_num(numbers[covered]),begins - begins[0],axis=0)
+	index = numpy.repeat(numpy.arange(len(groups)),ends - begins)
+	with numpy.errstate(divide="ignore",invalid="ignore"):
+		percent[covered] = 100*numbers[covered]/sums[index]
+	percent[~numpy.isfinite(percent)] = numpy.nan
+	return percent
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="calculate the percentage of every "
+		"isotopologue in its group of molecules. without arguments, the file "
+		"names are asked for")
+	parser.add_argument("input",nargs="?",help="input workbook")
+	parser.add_argument("output",nargs="?",help="output workbook")
+	parser.add_argument("--mode",choices=["formulas","values","both"],default="formulas",
+		help="write excel formulas (default), the computed values, or the values "
+		"followed by the formulas")
+	parser.add_argument("--name-column",type=int,help="number of the column used for "
+		"grouping, the \"Name\" column by default")
+	parser.add_argument("--data-column",type=int,help="number of the column where data "
+		"begins, the column after \"MZ\" by default")
+	parser.add_argument("--pattern",help="regular expression of the labeled names, "
+		"default: %s" % pattern.pattern)
+	return parser.parse_args()
+
+args = parse_args()
+interactive = args.input is None
+if args.pattern:
+	pattern = re.compile(args.pattern)
 #loading the file
-inF = raw_input("please enter the input filename:\n")
+if interactive:
+	inF = raw_input("please enter the input filename:\n")
+else:
+	inF = args.input
 if '.xls' not in inF:
 	if os.path.exists(inF + ".xls"):
 		inF += ".xls"
 	elif os.path.exists(inF + ".xlsx"):
 		inF += ".xlsx"
-		
-outname = raw_input("please enter the output filename\n")
+
+if args.output:
+	outname = args.output
+elif interactive:
+	outname = raw_input("please enter the output filename\n")
+else:
+	outname = os.path.splitext(inF)[0] + "_percent"
 if '.xls' not in outname:
 	outname += '.xlsx'
 if 'xls' not in inF:
 	print "print check the file type"
-	sys.exit()
+	sys.exit(1)
 
-inWb = load_workbook(inF,guess_types=True)
-sheet = inWb.active
-max_ncol = sheet.max_column
-max_nrow = sheet.max_row
+title,values = read_sheet(inF)
+max_nrow,max_ncol = values.shape
 print "There are: %i rows and %i columns" % (max_nrow,max_ncol)
 #find Elemental Composition and MZ columns
-header_row = sheet.rows.next()
-#header_row = sheet.rows[0]#on my notbook :
-if not header_row[-1].value:
+header_row = values[0]
+if not header_row[-1]:
 	print "Error columns number, please check !"
-	sys.exit()
+	sys.exit(1)
 group_column = -1
 data_begin = -1
-for i in header_row:
-	if str(i.value).strip().upper() == "NAME":
-		group_column = i.col_idx
-	if str(i.value).strip() == 'MZ':
-		data_begin = i.col_idx +1
+for col_idx,value in enumerate(header_row,1):
+	if str(value).strip().upper() == "NAME":
+		group_column = col_idx
+	if str(value).strip() == 'MZ':
+		data_begin = col_idx +1
+if args.name_column:
+	group_column = args.name_column
+if args.data_column:
+	data_begin = args.data_column
 if group_column == -1:
+	if not interactive:
+		print "Error: cannot find the \"Name\" column, please use --name-column"
+		sys.exit(1)
 	group_column = int(raw_input("Cannot find the \"Name\" column, please input:\n"))
 if data_begin == -1:
+	if not interactive:
+		print "Error: cannot find the \"MZ\" column, please use --data-column"
+		sys.exit(1)
 	data_begin = int(raw_input("Please input the column number where data begins:\n"))
+if not 1 <= group_column <= max_ncol or not 1 <= data_begin <= max_ncol:
+	print "Error: column numbers must be between 1 and %i" % max_ncol
+	sys.exit(1)
 
-#fill the headline
-for cell in header_row:
-	if cell.col_idx >= data_begin:
-		sheet.cell(row=1,column=cell.col_idx + max_ncol - data_begin +1, value=cell.value)
-#add the nature abundance
-#sheet.cell(row=1,column=cell.col_idx + max_ncol - data_begin +2,value="C13 nature abundance")
+groups = find_groups(values[:,group_column-1],pattern)
+ndata = max_ncol - data_begin + 1
+#the blocks of columns at the right side: (kind, first column)
+if args.mode == "both":
+	blocks = [("values",max_ncol+1),("formulas",max_ncol+ndata+1)]
+else:
+	blocks = [(args.mode,max_ncol+1)]
+if args.mode != "formulas":
+	percent = percentages(values[1:,data_begin-1:],groups)
+group_of_row = {}
+for sum_begin_row,sum_end_row in groups:
+	for row_i in range(sum_begin_row,sum_end_row+1):
+		group_of_row[row_i] = (sum_begin_row,sum_end_row)
 
-sum_begin_row = 2
-for row in sheet.rows:
-	if not str(row[group_column-1].value):
-		print "Error: please delete the blank rows"
-		sys.exit()
-	name = str(row[group_column-1].value).strip()
-	if (row[0].row > 2 and not re.match(pattern,name)) or row[0].row == max_nrow:
-		if row[0].row == max_nrow :
-			sum_end_row=row[0].row
-		else:
-			sum_end_row = row[0].row -1
-		#fill the calculate
-		row_range = range(sum_begin_row,sum_end_row+1)
-		for column_i in xrange(max_ncol+1,2*max_ncol-data_begin+2):
-			ref_column_i = column_i - max_ncol + data_begin -1
-			for row_i in row_range:
-				tmp_cell_coordinate = sheet.cell(row=row_i,column=ref_column_i).coordinate
-				tmp_beg = sheet.cell(row=sum_begin_row,column=ref_column_i).coordinate
-				tmp_end = sheet.cell(row=sum_end_row,column=ref_column_i).coordinate
-				tmp_string = '=100*'+tmp_cell_coordinate+'/sum('+tmp_beg+":"+tmp_end+")"
-				sheet.cell(row=row_i,column=column_i,value=tmp_string)
-		#calculate the C13 natural abundance (wrong):
-		# for r_idx,row_i in enumerate(row_range):
-		# 	tmp_string = '=power(%f,%i)*power(1-%f,%i)' % (c13_abundance_percet,r_idx,c13_abundance_percet,len(row_range)-r_idx-1)
-		# 	sheet.cell(row=row_i,column=2*max_ncol-data_begin+2,value=tmp_string)
-		sum_begin_row = row[0].row
-#add the border, make it more clearly.
-border_range(sheet,range(1,max_nrow+1),range(max_ncol+1,2*max_ncol-data_begin+2))
+#write the rows one by one, the copy of the values with the blocks at the right side
+outWb = Workbook(write_only=True)
+sheet = outWb.create_sheet(title)
+styles = border_styles()
+row_range = range(1,max_nrow+1)
+for row_i in row_range:
+	row = values[row_i-1].tolist()
+	for kind,first in blocks:
+		col_range = range(first,first+ndata)
+		for data_i in range(ndata):
+			ref_column_i = data_begin + data_i
+			value = None
+			if row_i == 1:
+				#fill the headline
+				value = header_row[ref_column_i-1]
+			elif kind == "values" and row_i in group_of_row:
+				if not numpy.isnan(percent[row_i-2,data_i]):
+					value = float(percent[row_i-2,data_i])
+			elif kind == "formulas" and row_i in group_of_row:
+				#fill the calculate
+				sum_begin_row,sum_end_row = group_of_row[row_i]
+				letter = get_column_letter(ref_column_i)
+				tmp_cell_coordinate = letter + str(row_i)
+				tmp_beg = letter + str(sum_begin_row)
+				tmp_end = letter + str(sum_end_row)
+				value = '=100*'+tmp_cell_coordinate+'/sum('+tmp_beg+":"+tmp_end+")"
+			#add the border, make it more clearly.
+			cell = WriteOnlyCell(sheet,value)
+			border = border_at(styles,row_i,first+data_i,row_range,col_range)
+			if border is not None:
+				cell.border = border
+			row.append(cell)
+	sheet.append(row)
 #end ^_^
-inWb.save(outname)
-
+outWb.save(outname)